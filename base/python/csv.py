@@ -296,6 +296,348 @@ class csv:
 
 
 
+#: Number of lines parsed at a time by :func:`read_chunks`. 
+READ_CHUNK_SIZE = 10000
+
+def typed_column(values, dtype=None): 
+  """ Convert a list of strings read from a CSV file to a NumPy array. 
+
+    If `dtype` isn't given, the narrowest of integer, float or string 
+    is used. Blank cells in a float column are NaN and in an integer 
+    column are 0. 
+
+  :param values: Cells of the column. 
+  :type values: str list
+  :param dtype: Type of the column. 
+  :type dtype: numpy.dtype
+  :rtype: numpy.ndarray
+  """
+  col = np.array(values, dtype=str)
+  if dtype is not None: 
+    kind = np.dtype(dtype).kind
+    if kind in 'iuf' and col.size > 0: 
+      col = np.where(col == '', 'nan' if kind == 'f' else '0', col)
+    return col.astype(dtype)
+  for dtype in (np.int64, np.float64): 
+    try: 
+      return col.astype(dtype)
+    except ValueError: 
+      pass
+  blank = (col == '')
+  if np.any(blank) and not np.all(blank): 
+    try: 
+      return np.where(blank, 'nan', col).astype(np.float64)
+    except ValueError: 
+      pass
+  return col
+
+
+def read_chunks(fn, chunk_size=None, dtypes={}): 
+  """ Read a CSV file in chunks of rows. 
+
+    Yields the column names and the columns of each chunk, a dictionary 
+    mapping column names to NumPy arrays (see :func:`typed_column`). The file is read 
+    line by line, so only one chunk is in memory at a time. Note that 
+    the type of a column is inferred per chunk unless it's given. 
+
+  :param fn: Input file name or file descriptor. 
+  :type fn: str, file
+  :param chunk_size: Rows per chunk, defaults to READ_CHUNK_SIZE. 
+  :type chunk_size: int
+  :param dtypes: Types of columns, by name. 
+  :type dtypes: dict
+  """
+  if chunk_size is None: 
+    chunk_size = READ_CHUNK_SIZE
+
+  fd = open(fn, 'r') if type(fn) == str else fn
+  try:
+    headers = fd.readline().strip().split(',')
+  except AttributeError: #fd not file-like
+    raise TypeError('read_chunks requires either the file path as a str or a open file object')
+  
+  def chunk(lines):
+    cells = zip(*lines) if len(lines) > 0 else [ [] ] * len(headers)
+    return dict((h, typed_column(list(c), dtypes.get(h))) for (h, c) in zip(headers, cells))
+
+  lines = []
+  line_no = 1
+  for line in fd:
+    line = line.strip().split(',')
+    if line == ['']: # Skip blank lines
+      continue
+    elif len(line) != len(headers): # Malformed line
+      raise error.QraatError("malformed row in CSV file (%d)" % line_no)
+    lines.append(line)
+    line_no += 1
+    if len(lines) == chunk_size:
+      yield (headers, chunk(lines))
+      lines = []
+  if len(lines) > 0 or line_no == 1: 
+    yield (headers, chunk(lines))
+  fd.close()
+
+
+class column_row (object): 
+  
+  """ A row of a :class:`column_csv` table. 
+    
+    Behaves like :class:`csv.Row`, but cells are read from and written 
+    to the table's columns. 
+  """ 
+
+  __slots__ = ('_table', '_i')
+
+  def __init__(self, table, i):
+    object.__setattr__(self, '_table', table)
+    object.__setattr__(self, '_i', i)
+
+  @property
+  def headers(self):
+    return self._table.headers
+
+  def __getattr__(self, col):
+    try: 
+      return self._table.columns[col][self._i]
+    except KeyError:
+      raise AttributeError(col)
+
+  def __setattr__(self, col, val):
+    self._table._set(col, self._i, val)
+
+  def __getitem__(self, col):
+    return getattr(self, col)
+
+  def __iter__(self):
+    for h in self.headers:
+      yield getattr(self, h)
+
+
+class column_rows (object): 
+
+  """ Sequence of the rows of a :class:`column_csv` table. """ 
+
+  def __init__(self, table):
+    self.table = table
+
+  def __len__(self):
+    return len(self.table.rows)
+
+  def __iter__(self):
+    for i in self.table.rows:
+      yield column_row(self.table, i)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [ column_row(self.table, j) for j in self.table.rows[i] ]
+    return column_row(self.table, self.table.rows[i])
+
+
+class column_csv (csv, object): 
+
+  """ 
+    A CSV table stored by column. Each column is a typed NumPy array 
+    (see :func:`typed_column`) rather than an attribute of a row object, 
+    which takes far less memory for large tables (e.g. est archives). 
+    Files are read in chunks with :func:`read_chunks`. The interface 
+    is the same as :class:`csv`; rows are views of the columns, so 
+    ``table[i].col`` reads (and assigning to it writes) the cell. 
+    
+    ``get()`` looks up a lazily built hash index on the queried columns 
+    and ``filter()`` returns a view of the table sharing its columns, 
+    rather than a copy. Query values are cast to the column's type, so 
+    ``get(ID='12')`` finds the row with integer ID 12. 
+
+  :param fn: Input file name or file descriptor. 
+  :type fn: str, file
+  :param dtypes: Types of columns, by name. Other types are inferred. 
+  :type dtypes: dict
+  :param db_con: DB connector. 
+  :type db_con: MySQLdb.connections.Conneection
+  :param table: Table name. 
+  :type table: str
+  """
+
+  def __init__(self, fn=None, dtypes={}, db_con=None, db_table=None, db_fields=None, db_where=None):
+    
+    #: Column names. 
+    self.headers = []
+
+    #: Column name -> NumPy array. Shared by views of the table. 
+    self.columns = {}
+
+    #: Indices in `columns` of the rows of this table. 
+    self.rows = np.arange(0)
+
+    self.dtypes = dtypes
+    self._version = [0] # Bumped when cells change; shared by views. 
+    self._index = {}
+
+    if fn: 
+      self.read(fn)
+
+    elif db_con and db_table: 
+      self.read_db(db_con, db_table, db_fields, db_where)
+
+  @property
+  def table(self):
+    return column_rows(self)
+
+  def read(self, fn, build_header=True): 
+    """ Read a CSV file. 
+    
+      :param fn: Input file name. 
+      :type fn: str
+    """
+    chunks = {}
+    for (headers, columns) in read_chunks(fn, dtypes=self.dtypes):
+      for (h, col) in columns.iteritems():
+        chunks.setdefault(h, []).append(col)
+    self.headers = headers
+    self._set_columns(dict((h, np.concatenate(c)) for (h, c) in chunks.iteritems()))
+
+  def read_db(self, db_con, table, fields=None, where_clause=None): 
+    """ Read a database table. See :func:`csv.read_db`. """ 
+    if not fields:
+      fields = '*'
+    sql_select = 'SELECT {0} FROM {1}'.format(fields,table)
+    if where_clause:
+      sql_select += ' WHERE {0}'.format(where_clause)
+
+    cur = db_con.cursor()
+    cur.execute(sql_select)
+    self.initialize_from_data([ d[0] for d in cur.description ], cur.fetchall())
+  
+  def initialize_from_data(self, headers_in, table_in):
+    for line in table_in:
+      if len(line) != len(headers_in): # Malformed line
+        raise error.QraatError("line: {0}: has a different number of fields than header: {1}".format(line,headers_in))
+    cells = zip(*table_in) if len(table_in) > 0 else [ [] ] * len(headers_in)
+    columns = {}
+    for (h, c) in zip(headers_in, cells):
+      if h in self.dtypes:
+        columns[h] = np.array(c, dtype=self.dtypes[h])
+      else:
+        col = np.array(c)
+        columns[h] = col if col.dtype.kind in 'ifS' else np.array(c, dtype=object)
+    self.headers = list(headers_in)
+    self._set_columns(columns)
+  
+  def write(self, fn, exclude=[]): 
+    """ Write data table to CSV file. Unlike :func:`csv.write`, floats 
+      are written with full precision, so that the file can be read 
+      back without loss. 
+
+      :param fn: Output file name or file descriptor. 
+      :type fn: str, file
+      :param exclude: Columns to exclude when writing the table. 
+      :type exclude: str list
+    """
+    headers = [col for col in self.headers if col not in exclude]
+    fd = open(fn, 'w') if type(fn) == str else fn
+
+    cols = []
+    for h in headers: 
+      col = self.columns[h][self.rows]
+      if col.dtype.kind == 'f': 
+        cols.append([ '' if np.isnan(v) else repr(v) for v in col.tolist() ])
+      else: 
+        cols.append([ pretty_printer(v) for v in col.tolist() ])
+    fd.write(','.join(headers) + '\n')
+    for line in zip(*cols):
+      fd.write(','.join(line) + '\n')
+
+  def get(self, **cols):
+    """ Get the first row that matches the given criteria. 
+    
+      Input is a list of *(column, value)* pairs.
+
+    :returns: qraat.csv.column_row.
+    """
+    keys = tuple(sorted(cols.keys()))
+    try:
+      val = tuple(self.__cast(col, cols[col]) for col in keys)
+    except (ValueError, TypeError): 
+      return None
+    i = self.__get_index(keys).get(val)
+    return column_row(self, i) if i is not None else None
+
+  def filter(self, **cols):
+    """ Filter a table. 
+       
+      Accept (col, val) pairs and returns a view of the rows of the table 
+      that match. This is equivelant to "SELECT table WHERE col1 = val1 
+      AND ... colN = valN;" in SQL terms. 
+
+    :returns: qraat.csv.column_csv
+    """
+    mask = np.ones(len(self.rows), dtype=bool)
+    for (col, val) in cols.iteritems():
+      try:
+        mask &= (self.columns[col][self.rows] == self.__cast(col, val))
+      except (ValueError, TypeError): 
+        mask[:] = False
+    filtered = copy.copy(self)
+    filtered.rows = self.rows[mask]
+    filtered._index = {}
+    return filtered
+
+  def __str__(self):
+    self._row_template = ' '.join('%-{0}s'.format(max([len(h)] + 
+        [ len(pretty_printer(v)) for v in self.columns[h][self.rows].tolist() ]))
+      for h in self.headers)
+    return csv.__str__(self)
+
+  def __getslice__(self, i, j):
+    return self.table[i:j]
+  
+  def _set_columns(self, columns):
+    self.columns.clear()
+    self.columns.update(columns)
+    self.rows = np.arange(len(columns.values()[0]) if len(columns) > 0 else 0)
+    self._version[0] += 1
+    self._index = {}
+
+  def _set(self, col, i, val):
+    ''' Set a cell, widening the column's type if necessary. ''' 
+    if col not in self.columns: 
+      self.columns[col] = np.array([None] * len(self.columns[self.headers[0]]), dtype=object)
+      self.headers.append(col)
+    column = self.columns[col]
+    kind = column.dtype.kind
+    if kind == 'S' and isinstance(val, str):
+      if len(val) > column.dtype.itemsize:
+        column = self.columns[col] = column.astype('S%d' % len(val))
+    elif kind == 'f' and isinstance(val, (int, long, float, np.number)):
+      pass
+    elif kind == 'i' and isinstance(val, (int, long, np.integer)):
+      pass
+    elif kind != 'O': 
+      column = self.columns[col] = column.astype(object)
+    column[i] = val
+    self._version[0] += 1
+
+  def __cast(self, col, val):
+    kind = self.columns[col].dtype.kind
+    if kind == 'i': 
+      return int(val)
+    elif kind == 'f': 
+      return float(val)
+    elif kind == 'S': 
+      return str(val)
+    return val
+
+  def __get_index(self, keys):
+    (version, index) = self._index.get(keys, (None, None))
+    if version != self._version[0]:
+      index = {}
+      cols = [ self.columns[col][self.rows].tolist() for col in keys ]
+      for (i, val) in zip(self.rows.tolist(), zip(*cols)): 
+        index.setdefault(val, i)
+      self._index[keys] = (self._version[0], index)
+    return index
+
+
 if __name__ == '__main__': # Testing, testing ... 
 
   import MySQLdb as mdb
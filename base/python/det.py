@@ -17,12 +17,74 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import numpy as np
-import os, time, re
+import os, time, re, struct
 
-from qraat.pulse_data import pulse_data
+try:
+  from qraat.pulse_data import pulse_data
+except ImportError:
+  pulse_data = None
 
 tag_regex = re.compile("([^/]*)_[0-9]*\.det$")
 
+#: Header of a pulse record, as written by ``pulse_data::write()``: 
+#: channel_ct, sample_ct, pulse_sample_ct, pulse_index, sample_rate, 
+#: ctr_freq, t_sec, t_usec. 
+det_header = struct.Struct('=iiiiffii')
+
+#: Number of pulse records stacked together by :func:`batch_signal`. 
+BATCH_SIZE = 256
+
+
+class py_pulse_data (object):
+
+  """ 
+
+    Pure Python reader of pulse records (.det files), used in place of 
+    :class:`qraat.pulse_data.pulse_data` when the Swig module isn't 
+    available. The header is followed by the samples as complex floats, 
+    interleaved by channel. Only the accessors used by :class:`det` 
+    are implemented. As in ``pulse_data``, `channel_ct` is 0 if the 
+    file couldn't be read. 
+
+  :param filename: The name of the .det file. 
+  :type filename: string
+  """
+
+  def __init__(self, fn):
+    self.filename = fn
+    self.channel_ct = 0
+    self.buffer = ''
+    try: 
+      fd = open(fn, 'rb')
+      header = fd.read(det_header.size)
+      if len(header) == det_header.size: 
+        (channel_ct, sample_ct, pulse_sample_ct, pulse_index, sample_rate, 
+         ctr_freq, t_sec, t_usec) = det_header.unpack(header)
+        size = np.dtype(np.complex64).itemsize * channel_ct * sample_ct
+        if channel_ct > 0 and sample_ct >= 0: 
+          self.buffer = fd.read(size)
+          if len(self.buffer) == size: 
+            (self.channel_ct, self.sample_ct, self.pulse_sample_ct, self.pulse_index, 
+             self.sample_rate, self.ctr_freq, self.t_sec, self.t_usec) = (channel_ct, 
+               sample_ct, pulse_sample_ct, pulse_index, sample_rate, ctr_freq, t_sec, t_usec)
+      fd.close()
+    except IOError: 
+      pass
+
+  def get_buffer(self):
+    """ Return the samples as a string of bytes. """
+    return self.buffer
+    
+  def r_sample(self, c, i): 
+    return float(np.frombuffer(self.buffer, np.complex64)[i*self.channel_ct + c].real)
+  
+  def i_sample(self, c, i): 
+    return float(np.frombuffer(self.buffer, np.complex64)[i*self.channel_ct + c].imag)
+
+if pulse_data is None: 
+  pulse_data = py_pulse_data
+
+
 class det (pulse_data):
   
   """ 
@@ -52,12 +114,10 @@ class det (pulse_data):
     self.n_cov = None          #: Result of :func:`det.noise_cov`. 
     self.tag_name = ""         #: Tag name parsed from input file name. 
     self.fn = fn 
-    self.data = np.zeros((self.sample_ct,self.channel_ct),np.complex)
-    for j in range(self.sample_ct):
-      for k in range(self.channel_ct):
-        r = self.r_sample(k,j)
-        i = self.i_sample(k,j)
-        self.data[j,k] = np.complex(r,i)
+    # Samples are interleaved by channel. They are widened to double
+    # precision for the signal calculations. 
+    self.data = np.frombuffer(self.get_buffer(), np.complex64).reshape(
+                        (self.sample_ct, self.channel_ct)).astype(np.complex)
     if np.any(np.isnan(self.data)):
       raise IOError("NaN in det data")#bad data samples
     self.pulse = self.data[self.pulse_index:self.pulse_index+self.pulse_sample_ct,:]
@@ -185,6 +245,84 @@ class det (pulse_data):
     return self.n_cov
 
 
+def batch_signal(dets): 
+  """ Calculate the signal features of many pulse records at once. 
+
+    Equivalent to calling :func:`det.f_signal`, :func:`det.eig` and 
+    :func:`det.noise_cov` on each pulse record, but pulses of the same 
+    shape are stacked into one array, so that the FFTs, covariances and 
+    eigenvalue decompositions are each done in a few vectorized calls. 
+    Results are stored in the instances as usual. Pulse records whose 
+    features were already calculated are skipped. 
+
+  :param dets: Pulse records. 
+  :type dets: :class:`qraat.det.det` list
+  """
+  groups = {} # shape of pulse and noise windows -> pulse records
+  for d in dets:
+    if d.f_sig is None or d.e_sig is None or d.n_cov is None:
+      key = (d.sample_ct, d.channel_ct, d.pulse_index, d.pulse_sample_ct)
+      groups.setdefault(key, []).append(d)
+
+  for ((sample_ct, channel_ct, pulse_index, pulse_sample_ct), group) in groups.iteritems():
+    for i in range(0, len(group), BATCH_SIZE):
+      _batch_signal(group[i:i+BATCH_SIZE], sample_ct, pulse_index, pulse_sample_ct)
+
+def _batch_signal(dets, sample_ct, pulse_index, pulse_sample_ct):
+  """ Calculate the signal features of pulse records of the same shape. """
+  pulse = np.array([ d.pulse for d in dets ])
+  sample_rate = np.array([ d.sample_rate for d in dets ])
+  ctr_freq = np.array([ d.ctr_freq for d in dets ])
+  ix = np.arange(len(dets))
+  
+  # Fourier analysis, see det.f_signal(). The power spectrum is real, 
+  # but is kept complex (with zero imaginary part) as in f_signal(). 
+  f = np.fft.fft(pulse, axis=1)
+  bin_width = sample_rate/pulse_sample_ct
+  f_pwr = np.sum(f.real**2 + f.imag**2, axis=2).astype(np.complex)
+  freq_index = np.argmax(f_pwr, axis=1)
+  peak = f_pwr[ix,freq_index]
+  f_sig = f[ix,freq_index,:]/np.sqrt(peak)[:,np.newaxis]
+  f_bandwidth3 = np.sum(f_pwr > (peak/2)[:,np.newaxis], axis=1)*bin_width
+  f_bandwidth10 = np.sum(f_pwr > (peak/10)[:,np.newaxis], axis=1)*bin_width
+  freq = freq_index*bin_width
+  neg = freq_index >= pulse_sample_ct/2
+  freq[neg] -= sample_rate[neg]
+  freq += ctr_freq
+  f_pwr = np.abs(peak)*bin_width
+
+  # Eigenvalue decomposition, see det.eig(). 
+  sq = np.matmul(pulse.conjugate().transpose(0,2,1), pulse)
+  (eigenvalues, eigenvectors) = np.linalg.eigh(sq)
+  e_index = np.argmax(eigenvalues, axis=1)
+  e_max = eigenvalues[ix,e_index]
+  e_pwr = e_max/pulse_sample_ct*sample_rate
+  e_conf = e_max/np.sum(eigenvalues, axis=1)
+  
+  # Noise covariance, see det.noise_cov(). 
+  if sample_ct - pulse_index >= pulse_sample_ct:
+    noise_start = int(sample_ct - pulse_index - pulse_sample_ct)/2
+    noise = np.array([ d.data[noise_start:noise_start+pulse_sample_ct,:] for d in dets ])
+    n_cov = np.matmul(noise.conjugate().transpose(0,2,1), noise)
+    n_cov = n_cov/pulse_sample_ct*sample_rate[:,np.newaxis,np.newaxis]
+  else:
+    n_cov = None
+
+  for (i, d) in enumerate(dets):
+    d.f = f[i]
+    d.f_sig = f_sig[i][:,np.newaxis]
+    d.f_bandwidth3 = f_bandwidth3[i]
+    d.f_bandwidth10 = f_bandwidth10[i]
+    d.freq = freq[i]
+    d.f_pwr = f_pwr[i]
+    d.eigenvalues = eigenvalues[i]
+    d.eigenvectors = eigenvectors[i]
+    d.e_sig = eigenvectors[i][:,e_index[i]:e_index[i]+1]
+    d.e_pwr = e_pwr[i]
+    d.e_conf = e_conf[i]
+    d.n_cov = n_cov[i] if n_cov is not None else np.array([[]])
+
+
 #testing stuff
 if __name__ == '__main__':
     df = det('test.det')
@@ -21,7 +21,7 @@
 #  - Deal with legacy headers in reading .csv files. 
 
 import qraat
-import sys, os, time, errno
+import sys, os, time, errno, itertools, multiprocessing, decimal
 import numpy as np
 from string import Template
 
@@ -67,6 +67,126 @@ query_update_est = Template(
      WHERE ID=$ID''')
 
 
+#: Columns of the est table written by :func:`est.write_db_bulk`, in the 
+#: order of :data:`query_insert_est_bulk`. The deployment ID is called 
+#: txid in the table. 
+insert_columns = [ 'siteid', 'timestamp', 'frequency', 'center', 'fdsp', 
+                   'fd1r', 'fd1i', 'fd2r', 'fd2i', 'fd3r', 'fd3i', 'fd4r', 'fd4i', 
+                   'band3', 'band10', 'edsp', 
+                   'ed1r', 'ed1i', 'ed2r', 'ed2i', 'ed3r', 'ed3i', 'ed4r', 'ed4i', 
+                   'ec', 'tnp', 
+                   'nc11r', 'nc11i', 'nc12r', 'nc12i', 'nc13r', 'nc13i', 'nc14r', 'nc14i', 
+                   'nc21r', 'nc21i', 'nc22r', 'nc22i', 'nc23r', 'nc23i', 'nc24r', 'nc24i', 
+                   'nc31r', 'nc31i', 'nc32r', 'nc32i', 'nc33r', 'nc33i', 'nc34r', 'nc34i', 
+                   'nc41r', 'nc41i', 'nc42r', 'nc42i', 'nc43r', 'nc43i', 'nc44r', 'nc44i', 
+                   'fdsnr', 'edsnr', 'txid' ]
+
+# Parameterized version of query_insert_est. A multi-row insert repeats the 
+# VALUES tuple (see `est.write_db_bulk()`). 
+query_insert_est_values = '(%s)' % ', '.join(['%s'] * len(insert_columns))
+query_insert_est_bulk = '''INSERT INTO est 
+       (%s, deploymentID)
+      VALUES %s''' % (', '.join(insert_columns[:-1]), query_insert_est_values)
+
+#: Maximum number of rows per multi-row insert in :func:`est.write_db_bulk`. 
+INSERT_BATCH_SIZE = 300
+
+#: Maximum length (in bytes) of a multi-row insert statement. It must be 
+#: less than the server's ``max_allowed_packet`` (1 MB by default); a row 
+#: takes about 1.4 kB. 
+INSERT_BATCH_BYTES = 2 ** 19
+
+
+#: Record type of est archives, as yielded by :func:`read_archive`. 
+#: Blank IDs are 0 and blank floats are NaN. 
+archive_dtype = np.dtype([ ('ID', np.int64) ] + 
+  [ (col, np.int64 if col in ['siteid', 'txid'] else np.float64) for col in insert_columns ] + 
+  [ ('tagname', 'S32'), ('fn', 'S128') ])
+
+#: Number of rows per batch yielded by :func:`read_archive`. 
+ARCHIVE_BATCH_SIZE = 10000
+
+
+def archive_files(base_dir): 
+  """ List the est archive files (.csv) under a directory, ordered by 
+    path. As the archive is organized by site and then by time 
+    (see :func:`est.write`), so are the files. 
+
+  :param base_dir: Root of the est archive, e.g. $RMG_SERVER_EST_ARCHIVE. 
+  :type base_dir: str
+  :rtype: str list
+  """
+  files = []
+  for (dirpath, dirnames, filenames) in os.walk(base_dir): 
+    dirnames.sort()
+    files += [ os.path.join(dirpath, fn) for fn in sorted(filenames) if fn.endswith('.csv') ]
+  return files
+
+def read_archive_file(fn): 
+  """ Read an est archive file into an array of :data:`archive_dtype`. 
+    Columns missing from the file are left as 0. 
+
+  :param fn: Name of the est archive file. 
+  :type fn: str
+  :rtype: numpy.ndarray
+  """
+  dtypes = dict((name, archive_dtype[name]) for name in archive_dtype.names)
+  tables = []
+  for (headers, columns) in qraat.csv.read_chunks(fn, dtypes=dtypes):
+    records = np.zeros(len(columns[headers[0]]), dtype=archive_dtype)
+    for name in archive_dtype.names: 
+      if name in columns: 
+        records[name] = columns[name]
+    tables.append(records)
+  return np.concatenate(tables)
+
+def read_archive(base_dir, batch_size=None, processes=None):
+  """ Stream the est archive under a directory in batches of records. 
+
+    Files are read in the order of :func:`archive_files` and the rows 
+    yielded as arrays of :data:`archive_dtype` of `batch_size` rows 
+    (the last batch may be shorter). With more than one process, files 
+    are read in parallel by a pool of workers; the order of the rows 
+    is the same. Batches can be given to :func:`est.append_records` 
+    or to :func:`qraat.srv.signal.Signal.read_records`. Rows archived 
+    before :func:`est.write_db_bulk` set the IDs of inserted rows carry 
+    no est ID, and are read with an ID of 0. 
+
+  :param base_dir: Root of the est archive, e.g. $RMG_SERVER_EST_ARCHIVE. 
+  :type base_dir: str
+  :param batch_size: Rows per batch, defaults to ARCHIVE_BATCH_SIZE. 
+  :type batch_size: int
+  :param processes: Number of worker processes. 
+  :type processes: int
+  """
+  if batch_size is None: 
+    batch_size = ARCHIVE_BATCH_SIZE
+
+  files = archive_files(base_dir)
+  pool = None
+  if processes > 1: 
+    pool = multiprocessing.Pool(processes)
+    tables = pool.imap(read_archive_file, files)
+  else: 
+    tables = itertools.imap(read_archive_file, files)
+
+  try:
+    (pending, ct) = ([], 0)
+    for records in tables: 
+      pending.append(records)
+      ct += len(records)
+      while ct >= batch_size: 
+        records = np.concatenate(pending)
+        yield records[:batch_size]
+        pending = [ records[batch_size:] ]
+        ct -= batch_size
+    if ct > 0: 
+      yield np.concatenate(pending)
+  finally: 
+    if pool is not None: 
+      pool.terminate()
+
+
 class est (qraat.csv.csv):
 
   """ 
@@ -139,8 +259,7 @@ class est (qraat.csv.csv):
       self.append(det)
 
     if dets:
-      for det in dets: 
-        self.append(det)
+      self.extend(dets)
 
 
   def write(self, base_dir='./'): 
@@ -235,6 +354,39 @@ class est (qraat.csv.csv):
     self.table.append(new_row)
 
 
+  def extend(self, dets):
+    """ Append the signals of many pulses to the table. 
+    
+      Signal features are calculated in batches by 
+      :func:`qraat.det.batch_signal`. 
+
+    :param dets: Pulse records. 
+    :type dets: qraat.det.det list
+    """
+    qraat.det.batch_signal(dets)
+    for det in dets: 
+      self.append(det)
+
+
+  def append_records(self, records):
+    """ Append rows from an array of est records, e.g. a batch from 
+      :func:`read_archive`. IDs that are 0 (blank in the archive) are 
+      None in the table, so the rows can be written with 
+      :func:`est.write_db_bulk`. 
+    
+    :param records: est records. 
+    :type records: numpy.ndarray
+    """
+    names = records.dtype.names
+    for values in records.tolist():
+      row = self.Row()
+      row.__dict__.update(zip(names, values))
+      for col in ['ID', 'siteid', 'txid']:
+        if getattr(row, col) == 0:
+          setattr(row, col, None)
+      self.table.append(row)
+
+
   def clear(self): 
     """ Clear table. """
     self.table = []
@@ -277,17 +429,166 @@ class est (qraat.csv.csv):
     for row in self.table: 
       self.write_db_row(cur, row, site) 
 
-  def write_db_row(self, cur, row, site=None):
-    """ Write a row to the database. 
-       
-      Resolve the transmitter ID by tag name and the site ID by ``site``, 
-      if these values aren't present in the table. This allows us to deal 
-      with legacy pulse sample metadata. 
-         
+  def write_db_bulk(self, db_con, site=None, batch_size=None):
+    """ Write new rows to the database in batches and commit. 
+
+      Transmitter and site IDs are resolved as in :func:`est.write_db_row`, 
+      but the lookup tables are fetched once per table. Rows are sent 
+      in batches of at most ``batch_size`` rows and INSERT_BATCH_BYTES 
+      bytes, each as a single multi-row INSERT statement, so that the 
+      IDs of a batch are consecutive from the statement's ``lastrowid`` 
+      (MySQLdb's ``executemany()`` may split a batch into several 
+      statements). If a batch fails, the rows that were written before 
+      the error are found (the est table is MyISAM, so they aren't rolled 
+      back) and the rest are written one at a time, so that only the bad 
+      rows are rejected. 
+      Rows that can't be written are returned along with the error; it's 
+      up to the caller to deal with them (e.g. quarantine the det file). 
+      Inserted rows are given their IDs, so that the table can then be 
+      archived with them (see :func:`est.write`); the IDs are checked 
+      against the site, deployment and timestamp of the records, and a 
+      row whose ID doesn't match is left without one. Rows that already 
+      have an ID are updated with :func:`est.write_db_row`. 
+
+      :param db_con: DB connector for MySQL. 
+      :type db_con: MySQLdb.connections.Connection
+      :param site: Name of the site where the signal was recorded. 
+      :type site: str
+      :param batch_size: Maximum rows per insert, defaults to 
+                         INSERT_BATCH_SIZE. 
+      :type batch_size: int
+      :returns: The range ``(i, j)`` of IDs of inserted rows (None if no 
+                rows were inserted) and a list of ``(row, error)`` pairs. 
+    """
+    
+    if batch_size is None: 
+      batch_size = INSERT_BATCH_SIZE
+
+    cur = db_con.cursor()
+    (ids, failed, rows) = ([], [], [])
+    for row in self.table:
+      try:
+        if row.ID is not None: 
+          self.write_db_row(cur, row, site)
+        else: 
+          self.resolve_ids(cur, row, site)
+          row.timestamp = repr(row.timestamp) # See write_db_row(). 
+          rows.append(row)
+      except Exception as e: 
+        failed.append((row, e))
+
+    # Rows of this call have IDs above `floor`. 
+    floor = None
+    for batch in self.__batches(rows, batch_size):
+      if floor is None: 
+        cur.execute('SELECT IFNULL(MAX(ID), 0) FROM est')
+        floor = int(cur.fetchone()[0])
+      try:
+        query = query_insert_est_bulk + (', ' + query_insert_est_values) * (len(batch) - 1)
+        cur.execute(query, tuple(itertools.chain(*map(self.__insert_params, batch))))
+        for (k, row) in enumerate(batch):
+          row.ID = cur.lastrowid + k
+        ids += [cur.lastrowid, cur.lastrowid + len(batch) - 1]
+      except Exception: 
+        written = self.__written_ids(cur, batch, floor)
+        for (row, id) in zip(batch, written): 
+          row.ID = id
+        ids += written
+        for row in batch[len(written):]:
+          try:
+            cur.execute(query_insert_est_bulk, self.__insert_params(row))
+            row.ID = cur.lastrowid
+            ids.append(cur.lastrowid)
+          except Exception as e: 
+            failed.append((row, e))
+      if len(ids) > 0: 
+        floor = max(floor, max(ids))
+
+    # Check the IDs against the database, so that rows aren't archived 
+    # with the IDs of other records. 
+    if len(ids) > 0: 
+      self.__check_ids(cur, rows, min(ids), max(ids))
+
+    db_con.commit()
+    id_range = (min(ids), max(ids)) if len(ids) > 0 else None
+    return (id_range, failed)
+
+  def __batches(self, rows, batch_size): 
+    """ Split ``rows`` into batches of at most ``batch_size`` rows whose 
+      insert statement takes at most INSERT_BATCH_BYTES. The literal of a 
+      value is assumed to be no longer than its ``repr()``. 
+    """
+    (batch, size) = ([], len(query_insert_est_bulk))
+    for row in rows: 
+      ct = len(', '.join(map(repr, self.__insert_params(row)))) + 4
+      if len(batch) > 0 and (len(batch) == batch_size or size + ct > INSERT_BATCH_BYTES): 
+        yield batch
+        (batch, size) = ([], len(query_insert_est_bulk))
+      batch.append(row)
+      size += ct
+    if len(batch) > 0: 
+      yield batch
+
+  def __check_ids(self, cur, rows, i, j): 
+    """ Clear the ID of each of ``rows`` that isn't that of an est record 
+      with the same site, deployment and timestamp, among IDs ``i`` to 
+      ``j``. 
+    """
+    cur.execute('''SELECT ID, siteID, deploymentID, timestamp 
+                     FROM est WHERE ID >= %s AND ID <= %s''', (i, j))
+    written = dict((int(row[0]), self.__row_key(*row[1:])) for row in cur.fetchall())
+    for row in rows: 
+      if row.ID is not None and (written.get(row.ID) != 
+                                 self.__row_key(row.siteid, row.txid, row.timestamp)): 
+        row.ID = None
+
+  def __row_key(self, site_id, dep_id, timestamp): 
+    """ Site, deployment and timestamp of a row, as compared with those of 
+      an est record. Timestamps are rounded to the precision of the table. 
+    """
+    return (None if site_id is None else int(site_id), 
+            None if dep_id is None else int(dep_id), 
+            None if timestamp is None else decimal.Decimal(str(timestamp)).quantize(
+                                     decimal.Decimal('0.000001'), decimal.ROUND_HALF_UP))
+
+  def __written_ids(self, cur, batch, floor): 
+    """ IDs of the leading rows of a failed insert of ``batch`` that were 
+      written anyway. They're consecutive rows with IDs above ``floor``, 
+      matched by site, deployment and timestamp. 
+    """
+    cur.execute('''SELECT ID, siteID, deploymentID, timestamp 
+                     FROM est WHERE ID > %s ORDER BY ID''', (floor,))
+    result = [ (int(row[0]), self.__row_key(*row[1:])) for row in cur.fetchall() ]
+    batch = [ self.__row_key(row.siteid, row.txid, row.timestamp) for row in batch ]
+    for (k, (_, first)) in enumerate(result):
+      if first == batch[0]: 
+        ids = []
+        for ((id, written), row) in zip(result[k:], batch): 
+          if written != row: 
+            break
+          ids.append(id)
+        return ids
+    return []
+
+  def __insert_params(self, row):
+    params = []
+    for col in insert_columns:
+      val = getattr(row, col)
+      if val is not None and col != 'timestamp':
+        val = int(val) if col in ['siteid', 'txid'] else float(val)
+      params.append(val)
+    return tuple(params)
+
+  def resolve_ids(self, cur, row, site=None):
+    """ Resolve the transmitter ID by tag name and the site ID by ``site``, 
+      if these values aren't present in the row. 
+
       :param cur: DB cursor for MySQL. 
       :type cur: MySQLdb.cursors.Cursor
       :param row: The row.  
       :type row: est.Row
+      :param site: Name of the site where the signal was recorded. 
+      :type site: str
     """
 
     if row.txid is None: 
@@ -309,6 +610,21 @@ class est (qraat.csv.csv):
       except KeyError:
         raise qraat.error.ResolveIdError('siteid',site,row.fn)
 
+  def write_db_row(self, cur, row, site=None):
+    """ Write a row to the database. 
+       
+      Resolve the transmitter ID by tag name and the site ID by ``site``, 
+      if these values aren't present in the table. This allows us to deal 
+      with legacy pulse sample metadata. 
+         
+      :param cur: DB cursor for MySQL. 
+      :type cur: MySQLdb.cursors.Cursor
+      :param row: The row.  
+      :type row: est.Row
+    """
+
+    self.resolve_ids(cur, row, site)
+
     query = query_insert_est if row.ID is None else query_update_est
     # When the template string performs the substitution, it casts 
     # floats to strings with `str(val)`. This rounds the decimal 
@@ -57,6 +57,13 @@
   float i_sample(int c, int i) {
     return $self->get_sample(c,i).imag();
   }
+  /* Return the samples as a string of bytes, one complex float per
+   * sample per channel, interleaved by channel. The data are copied 
+   * once; wrap with numpy.frombuffer(). */
+  PyObject *get_buffer() {
+    return PyString_FromStringAndSize((const char *) $self->get_data(), 
+      sizeof(my_complex) * $self->sample_ct * $self->channel_ct);
+  }
 };
 
 
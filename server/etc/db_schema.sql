@@ -428,6 +428,16 @@ CREATE TABLE IF NOT EXISTS qraat.`track_pos` (
   KEY `deploymentID` (`deploymentID`,`timestamp`)
 ) ENGINE=MyISAM;
 
+CREATE TABLE IF NOT EXISTS qraat.`track_node` (
+  `positionID` bigint(20) unsigned NOT NULL,
+  `deploymentID` int(10) unsigned NOT NULL,
+  `timestamp` decimal(16,6) NOT NULL,
+  `dist` double NOT NULL COMMENT 'Length of the longest track ending at this position.',
+  `parentID` bigint(20) unsigned DEFAULT NULL COMMENT 'Previous position on that track.',
+  PRIMARY KEY (`positionID`),
+  KEY `deploymentID` (`deploymentID`,`timestamp`)
+) ENGINE=MyISAM;
+
 
 CREATE TABLE IF NOT EXISTS qraat.`provenance` (
   `ID` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
@@ -438,6 +448,17 @@ CREATE TABLE IF NOT EXISTS qraat.`provenance` (
   PRIMARY KEY (`ID`)
 ) ENGINE=MyISAM;
 
+CREATE TABLE IF NOT EXISTS qraat.`provenance_range` (
+  `ID` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
+  `obj_table` varchar(30) NOT NULL,
+  `obj_id` bigint(20) unsigned NOT NULL,
+  `dep_table` varchar(30) NOT NULL,
+  `dep_start` bigint(20) unsigned NOT NULL COMMENT 'First dependency ID of a contiguous range',
+  `dep_end` bigint(20) unsigned NOT NULL COMMENT 'Last dependency ID of the range (inclusive)',
+  PRIMARY KEY (`ID`),
+  KEY `obj` (`obj_table`,`obj_id`)
+) ENGINE=MyISAM;
+
 
 -- Processing
 CREATE TABLE IF NOT EXISTS qraat.`processing_cursor` (
@@ -1,12 +1,96 @@
+import os, struct, tempfile
 import numpy as np
 from PIL import Image
 from geographiclib.geodesic import Geodesic
 
+# Distance (meters) between the samples taken along a line of sight.
+LOS_STEP_SIZE = 10
+
+# Number of DEM rows whose elevation angles are computed at once by
+# line_of_sight.calc_elevation_angle_array(). This bounds the memory
+# used for the intermediate coordinate arrays.
+LOS_BLOCK_ROWS = 512
+
+def local_coordinates(lat0, lon0, lat, lon):
+  ''' Project points onto the plane tangent to the WGS84 ellipsoid at
+    (lat0, lon0). Return (east, north) offsets in meters. Over the
+    few kilometers covered by a DEM, distances in this plane agree
+    with geodesic distances to well within the DEM resolution.
+    Works element-wise on arrays.
+  '''
+  a, f = Geodesic.WGS84.a, Geodesic.WGS84.f
+  e2 = f * (2 - f)
+  phi = np.radians(lat0)
+  w = 1 - e2 * np.sin(phi) ** 2
+  m = a * (1 - e2) / w ** 1.5  # meridional radius of curvature
+  n = a / np.sqrt(w)           # prime vertical radius of curvature
+  lat = np.asarray(lat, dtype=float)
+  east = np.radians(np.asarray(lon, dtype=float) - lon0) * n * np.cos(np.radians(lat + lat0) / 2)
+  north = np.radians(lat - lat0) * m
+  return east, north
+
+# Sizes (bytes) of the TIFF field types.
+TIFF_TYPE_SIZES = { 1 : 1, 2 : 1, 3 : 2, 4 : 4, 5 : 8, 6 : 1, 7 : 1,
+                    8 : 2, 9 : 4, 10 : 8, 11 : 4, 12 : 8 }
+
+# Numpy kinds of the TIFF SampleFormat values.
+TIFF_SAMPLE_FORMATS = { 1 : 'u', 2 : 'i', 3 : 'f' }
+
+def _tiff_layout(tif):
+  ''' Find the pixel data of a TIFF file, if it can be memory-mapped.
+    That's the case for an uncompressed, single-band image stored in
+    contiguous strips. Return (offset, dtype, shape), or None
+    otherwise. Only the first image of the file is considered.
+  '''
+  with open(tif, 'rb') as f:
+    order = { 'II' : '<', 'MM' : '>' }.get(f.read(2))
+    if order is None or struct.unpack(order + 'H', f.read(2))[0] != 42:
+      return None # Not a TIFF, or a BigTIFF.
+    f.seek(struct.unpack(order + 'I', f.read(4))[0])
+    tags = {}
+    for _ in range(struct.unpack(order + 'H', f.read(2))[0]):
+      (tag, typ, count, value) = struct.unpack(order + 'HHI4s', f.read(12))
+      if typ not in (3, 4):
+        continue
+      fmt = order + str(count) + ('H' if typ == 3 else 'I')
+      if count * TIFF_TYPE_SIZES[typ] > 4:
+        pos = f.tell()
+        f.seek(struct.unpack(order + 'I', value)[0])
+        tags[tag] = struct.unpack(fmt, f.read(count * TIFF_TYPE_SIZES[typ]))
+        f.seek(pos)
+      else:
+        tags[tag] = struct.unpack(fmt, value[:count * TIFF_TYPE_SIZES[typ]])
+
+  (width, height) = (tags[256][0], tags[257][0])
+  bits = tags.get(258, (1,))[0]
+  kind = TIFF_SAMPLE_FORMATS.get(tags.get(339, (1,))[0])
+  if (tags.get(259, (1,))[0] != 1 or tags.get(277, (1,))[0] != 1 or
+      324 in tags or 273 not in tags or 279 not in tags or
+      kind is None or bits % 8 != 0):
+    return None # Compressed, multi-band, tiled, or an unusual sample type.
+  (offsets, counts) = (tags[273], tags[279])
+  if (any(offsets[k] + counts[k] != offsets[k+1] for k in range(len(offsets) - 1))
+      or sum(counts) != width * height * bits / 8):
+    return None # Strips aren't contiguous.
+  return (offsets[0], np.dtype(order + kind + str(bits / 8)), (height, width))
+
 class elevation_model:
+  ''' Digital elevation model given by a GeoTIFF and its world file.
 
-  def __init__(self, tif, tfw):
-    im = Image.open(tif)
-    self.elevation_array = np.array(im)
+    Uncompressed images stored in contiguous strips are memory-mapped,
+    so that only the parts of the DEM that are actually sampled are
+    read from disk. Other images are decoded fully with PIL.
+  '''
+
+  def __init__(self, tif, tfw, mmap=True):
+    self.tif = tif
+    layout = _tiff_layout(tif) if mmap else None
+    if layout is not None:
+      (offset, dtype, shape) = layout
+      self.elevation_array = np.memmap(tif, dtype=dtype, mode='r', offset=offset, shape=shape)
+    else:
+      im = Image.open(tif)
+      self.elevation_array = np.array(im)
     with open(tfw) as f:
       self.scale_data = np.loadtxt(f, dtype=float, delimiter='\n')
     self.max_x = self.elevation_array.shape[0]
@@ -24,24 +108,124 @@ class elevation_model:
     lon = self.scale_data[0]*y_index+self.scale_data[1]*x_index+self.scale_data[4]
     return lat, lon
 
-  def get_elevation(self, lat, lon):
-    #closest point on grid
+  def contains(self, lat, lon):
+    ''' Whether the points fall within the grid, i.e. their nearest grid
+      point isn't clamped. Works element-wise on arrays.
+    '''
+    x,y = self.latlon_to_index(np.asarray(lat), np.asarray(lon))
+    return ((x >= -0.5) & (x < self.max_x-0.5) &
+            (y >= -0.5) & (y < self.max_y-0.5))
+
+  def nearest_index(self, lat, lon):
+    ''' Index of the closest point on the grid, clamped to its edges.
+      Works element-wise on arrays.
+    '''
     x,y = self.latlon_to_index(lat,lon)
-    int_x = int(round(x))
-    if int_x < 0:
-      int_x = 0
-    elif int_x >= self.elevation_array.shape[0]:
-      int_x = self.elevation_array.shape[0]-1
-    int_y = int(round(y))
-    if int_y < 0:
-      int_y = 0
-    elif int_y >= self.elevation_array.shape[1]:
-      int_y = self.elevation_array.shape[1]-1
-    return self.elevation_array[int_x,int_y]
+    int_x = np.clip(np.floor(np.asarray(x) + 0.5), 0, self.max_x-1).astype(int)
+    int_y = np.clip(np.floor(np.asarray(y) + 0.5), 0, self.max_y-1).astype(int)
+    return int_x, int_y
+
+  def get_elevation(self, lat, lon, bilinear=False):
+    ''' Sample the elevation model. Points off the grid get the
+      elevation of its edge.
+
+      Inputs:
+
+        lat, lon -- position of the points. Scalars or arrays of the
+                    same shape.
+
+        bilinear -- if True, interpolate between the four surrounding
+                    grid points. Otherwise, use the closest one.
+
+      Returns a scalar or an array of the shape of the input.
+    '''
+    if not bilinear:
+      #closest point on grid
+      x,y = self.nearest_index(lat,lon)
+      return self.elevation_array[x,y]
+
+    x,y = self.latlon_to_index(np.asarray(lat, dtype=float),
+                               np.asarray(lon, dtype=float))
+    x0 = np.clip(np.floor(x), 0, max(self.max_x-2, 0)).astype(int)
+    y0 = np.clip(np.floor(y), 0, max(self.max_y-2, 0)).astype(int)
+    x1 = np.minimum(x0+1, self.max_x-1)
+    y1 = np.minimum(y0+1, self.max_y-1)
+    fx = np.clip(x - x0, 0, 1)
+    fy = np.clip(y - y0, 0, 1)
+    e = self.elevation_array
+    return ((1-fx) * ((1-fy) * e[x0,y0] + fy * e[x0,y1]) +
+                fx * ((1-fy) * e[x1,y0] + fy * e[x1,y1]))
+
+class elevation_mosaic:
+  ''' Elevation model of a study area covered by several DEM tiles.
+
+    Inputs:
+
+      tiles -- list of (tif, tfw) file pairs. Each tile is opened (and
+               memory-mapped where possible) the first time a point falls
+               within its bounds. Where tiles overlap, the first one
+               listed is used.
+  '''
+
+  def __init__(self, tiles, mmap=True):
+    self.tiles = list(tiles)
+    self.mmap = mmap
+    self.models = [None] * len(self.tiles)
+    # Bounds come from the world files and the image sizes, for which
+    # PIL only reads the header. No tile is loaded until it's needed.
+    self.bounds = []
+    for (tif, tfw) in self.tiles:
+      with open(tfw) as f:
+        s = np.loadtxt(f, dtype=float, delimiter='\n')
+      (width, height) = Image.open(tif).size
+      corners_lat = s[2]*np.array([-0.5, -0.5, width-0.5, width-0.5]) + s[3]*np.array([-0.5, height-0.5, -0.5, height-0.5]) + s[5]
+      corners_lon = s[0]*np.array([-0.5, -0.5, width-0.5, width-0.5]) + s[1]*np.array([-0.5, height-0.5, -0.5, height-0.5]) + s[4]
+      self.bounds.append((corners_lat.min(), corners_lat.max(),
+                          corners_lon.min(), corners_lon.max()))
+
+  def get_model(self, k):
+    if self.models[k] is None:
+      (tif, tfw) = self.tiles[k]
+      self.models[k] = elevation_model(tif, tfw, self.mmap)
+    return self.models[k]
+
+  def get_elevation(self, lat, lon, bilinear=False):
+    ''' Sample the tiles at the points, as elevation_model.get_elevation()
+      does. Points outside of every tile get NaN. Returns a scalar or an
+      array of the shape of the input.
+    '''
+    (lat, lon) = np.broadcast_arrays(np.asarray(lat, dtype=float),
+                                     np.asarray(lon, dtype=float))
+    shape = lat.shape
+    (lat, lon) = (lat.ravel(), lon.ravel())
+    elevation = np.nan * np.ones(lat.shape)
+    todo = np.arange(lat.shape[0])
+    for (k, (min_lat, max_lat, min_lon, max_lon)) in enumerate(self.bounds):
+      inside = ((lat[todo] >= min_lat) & (lat[todo] <= max_lat) &
+                (lon[todo] >= min_lon) & (lon[todo] <= max_lon))
+      if not inside.any():
+        continue
+      em = self.get_model(k)
+      mask = em.contains(lat[todo[inside]], lon[todo[inside]])
+      index = todo[inside][mask]
+      elevation[index] = em.get_elevation(lat[index], lon[index], bilinear)
+      todo = np.setdiff1d(todo, index, assume_unique=True)
+      if todo.shape[0] == 0:
+        break
+    if len(shape) == 0:
+      return elevation[0]
+    return elevation.reshape(shape)
 
 class line_of_sight():
+  ''' Line of sight from a site over an elevation model.
+
+    If `cache_dir` is given, the elevation angle raster computed by
+    calc_elevation_angle_array() is saved there as a .npy file and
+    loaded on later runs. Files are keyed by the name of the DEM and the
+    site position; remove them if the DEM changes.
+  '''
 
-  def __init__(self, em, lat, lon, elevation=None):
+  def __init__(self, em, lat, lon, elevation=None, cache_dir=None):
     self.em = em
     self.lat = lat
     self.lon = lon
@@ -49,64 +233,111 @@ class line_of_sight():
       self.elevation = self.em.get_elevation(self.lat, self.lon)
     else:
       self.elevation = elevation
+    self.cache_dir = cache_dir
     self.elevation_angle = None
 
+  def cache_path(self):
+    if self.cache_dir is None:
+      return None
+    name = os.path.splitext(os.path.basename(self.em.tif))[0]
+    return os.path.join(self.cache_dir,
+      '{}.{:.6f}.{:.6f}.{:.2f}.npy'.format(name, self.lat, self.lon, float(self.elevation)))
+
   def calc_elevation_angle_array(self):
+    ''' Compute the elevation angle from the site to every point on the
+      grid, in blocks of LOS_BLOCK_ROWS rows. The raster is read from
+      (or written to) the cache directory if there is one.
+    '''
+    fn = self.cache_path()
+    if fn is not None and os.path.isfile(fn):
+      self.elevation_angle = np.load(fn, mmap_mode='r')
+      return
+
     self.elevation_angle = np.zeros(self.em.elevation_array.shape)
-    for j in range(self.elevation_angle.shape[0]):
-      for k in range(self.elevation_angle.shape[1]):
-        to_lat,to_lon = self.em.index_to_latlon(j, k)
-        self.elevation_angle[j,k] = calc_elevation_angle(to_lat, to_lon, elevation=self.em.elevation_array[j,k])
+    y = np.arange(self.em.max_y)
+    for i in range(0, self.em.max_x, LOS_BLOCK_ROWS):
+      x = np.arange(i, min(i + LOS_BLOCK_ROWS, self.em.max_x))
+      to_lat,to_lon = self.em.index_to_latlon(x[:,np.newaxis], y[np.newaxis,:])
+      self.elevation_angle[x] = self.calc_elevation_angle(to_lat, to_lon,
+                                        elevation=self.em.elevation_array[x])
+
+    if fn is not None:
+      # Write under a temporary name, so that a partial file is never loaded.
+      if not os.path.exists(self.cache_dir):
+        os.makedirs(self.cache_dir)
+      (fd, tmp) = tempfile.mkstemp(dir=self.cache_dir, suffix='.npy')
+      with os.fdopen(fd, 'wb') as f:
+        np.save(f, self.elevation_angle)
+      os.rename(tmp, fn)
 
+  def calc_distance(self, to_lat, to_lon):
+    east, north = local_coordinates(self.lat, self.lon, to_lat, to_lon)
+    return np.hypot(east, north)
 
   def calc_elevation_angle(self, to_lat, to_lon, dist=None, elevation=None):
     if dist is None:
-      g = Geodesic.WGS84.Inverse(self.lat, self.lon, to_lat, to_lon)
-      dist = g['s12']
+      dist = self.calc_distance(to_lat, to_lon)
     if elevation is None:
       elevation = self.em.get_elevation(to_lat,to_lon)
     return np.arctan2(elevation-self.elevation, dist)
 
   def get_elevation_angle(self, lat, lon, dist=None, elevation=None):
-    #closest point on grid
-    x,y = self.em.latlon_to_index(lat,lon)
-    int_x = int(round(x))
-    if int_x < 0:
-      int_x = 0
-    elif int_x >= self.em.max_x:
-      int_x = self.em.max_x-1
-    int_y = int(round(y))
-    if int_y < 0:
-      int_y = 0
-    elif int_y >= self.em.max_y:
-      int_y = self.em.max_y-1
-    if elevation is None:
-      if self.elevation_angle:
-        ea = self.elevation_angle[int_x,int_y]
-      else:
-        ea = self.calc_elevation_angle(lat, lon, dist, self.em.elevation_array[int_x,int_y])
-    else:
-      ea = self.calc_elevation_angle(lat, lon, dist, elevation)
-    return ea
+    if elevation is not None:
+      return self.calc_elevation_angle(lat, lon, dist, elevation)
+    if self.elevation_angle is not None:
+      #closest point on grid
+      x,y = self.em.nearest_index(lat,lon)
+      return self.elevation_angle[x,y]
+    return self.calc_elevation_angle(lat, lon, dist, self.em.get_elevation(lat,lon))
 
   def can_see(self, lat, lon, elev=None):
-    step_size = 10
-    g = Geodesic.WGS84.Inverse(self.lat, self.lon, lat, lon)
-    geo_line = Geodesic.WGS84.Line(self.lat, self.lon, g['azi1'])
-    ea = self.get_elevation_angle(lat,lon, g['s12'], elev)
-    dist = g['s12']-step_size
-    can_see_bool = True
-    while dist > 0:
-      new_loc = geo_line.Position(dist)
-      test_ea = self.get_elevation_angle(new_loc['lat2'],new_loc['lon2'], dist)
-      if test_ea > ea:
-        can_see_bool = False
-        break
-      dist -= step_size
-    return can_see_bool
+    ''' Whether the points are visible from the site.
+
+      Each point is tested by walking back toward the site in steps of
+      LOS_STEP_SIZE meters; it's hidden if the elevation angle of the
+      terrain anywhere along the way exceeds its own. All points are
+      marched together, and dropped as soon as they're found hidden.
+
+      Inputs:
+
+        lat, lon -- position of the points. Scalars or arrays of the
+                    same shape.
+
+        elev -- elevation of the points. If None, the elevation model
+                is used.
+
+      Returns a boolean, or an array of booleans of the shape of the input.
+    '''
+    (lat, lon) = np.broadcast_arrays(np.asarray(lat, dtype=float),
+                                     np.asarray(lon, dtype=float))
+    shape = lat.shape
+    (lat, lon) = (lat.ravel(), lon.ravel())
+    dist = self.calc_distance(lat, lon)
+    if elev is not None:
+      elev = np.broadcast_to(np.asarray(elev, dtype=float), shape).ravel()
+    ea = np.broadcast_to(self.get_elevation_angle(lat, lon, dist, elev), lat.shape)
+
+    can_see_bool = np.ones(lat.shape, dtype=bool)
+    active = np.arange(lat.shape[0])
+    step = 1
+    while active.shape[0] > 0:
+      test_dist = dist[active] - step * LOS_STEP_SIZE
+      mask = test_dist > 0
+      (active, test_dist) = (active[mask], test_dist[mask])
+      t = test_dist / dist[active]
+      test_ea = self.get_elevation_angle(self.lat + t * (lat[active] - self.lat),
+                                         self.lon + t * (lon[active] - self.lon),
+                                         test_dist)
+      hidden = test_ea > ea[active]
+      can_see_bool[active[hidden]] = False
+      active = active[~hidden]
+      step += 1
+
+    if len(shape) == 0:
+      return bool(can_see_bool[0])
+    return can_see_bool.reshape(shape)
 
 if __name__ == '__main__':
   em = elevation_model('/home/todd/qraat_workspace/QR_topo/50245025.tif', '/home/todd/qraat_workspace/QR_topo/50245025.tfw')
   los = line_of_sight(em, 38.495196, -122.151395)
   print los.can_see(38.45,-122.15,-100)
-
@@ -3,6 +3,7 @@
 # High level calls, database interaction: 
 #  - PositionEstimator
 #  - WindowedPositionEstimator
+#  - WindowedPositionEstimatorAsync
 #  - InsertPositions
 #  - ReadPositions
 #  - ReadBearings
@@ -11,6 +12,7 @@
 # Objects defined here: 
 #  - class Position
 #  - class Bearing
+#  - class SearchGrid
 #
 # Copyright (C) 2015 Chris Patton, Todd Borrowman, Sean Riddle
 # 
@@ -44,6 +46,28 @@ STEPSIZE = 5
 # Normalize bearing spectrum. 
 NORMALIZE_SPECTRUM = False
 
+# Evaluation of the bearing likelihoods on the coarse pass of the grid search. 
+# Either 'linear' or 'nearest' to look up the 360-bin spectrum with a cached 
+# `SearchGrid`, or None to evaluate the bearing splines at every point. 
+COARSE_LOOKUP = 'linear'
+
+# Position search algorithm. 'pyramid' refines the best points of a coarse 
+# `stepsize` grid through the finer of `SEARCH_LEVELS` (meters), keeping 
+# `SEARCH_SEEDS` candidates at each level and evaluating at most 
+# `SEARCH_MAX_POINTS` points per estimate. 'grid' is a `stepsize` grid over 
+# the search space followed by a 1 meter grid over the points above 90% of 
+# the maximum likelihood. 
+SEARCH_METHOD = 'pyramid'
+SEARCH_LEVELS = [50, 10, 2, 0.5]
+SEARCH_SEEDS = 8
+SEARCH_MAX_POINTS = 20000
+
+# Encoding of the provenance of bearings and positions. If True, each 
+# contiguous run of dependency IDs (e.g. the est records of a bearing) is 
+# stored as one row of `provenance_range`, rather than a row per ID in 
+# `provenance`. Use `read_provenance()` to read either. 
+PROVENANCE_RANGES = False
+
 
 
 ### High level function calls. ################################################
@@ -51,7 +75,7 @@ NORMALIZE_SPECTRUM = False
 def PositionEstimator(signal, sites, sv,
                         stepsize = STEPSIZE, emin = EASTING_MIN, emax=EASTING_MAX,
                         nmin = NORTHING_MIN, nmax = NORTHING_MAX,
-                        method=signal.Signal.Bartlet):
+                        method=signal.Signal.Bartlet, pool=None):
   ''' Estimate the source of a signal. 
   
     Inputs: 
@@ -68,12 +92,13 @@ def PositionEstimator(signal, sites, sv,
 
       stepsize, emin, emax, nmin, nmax -- Parameters for position estimation algorithm. 
 
+      pool -- instance of `class signal.SpectrumPool`. If provided, the bearing 
+              spectra are computed by the pool's worker processes. 
+
     Returns an instance of `class position.Position`. 
   ''' 
   if len(signal) > 0: 
-    bearing_spectrum = {} # Compute bearing likelihood distributions.  
-    for site_id in signal.get_site_ids().intersection(sv.get_site_ids()): 
-      bearing_spectrum[site_id] = method(signal[site_id], sv)
+    bearing_spectrum = compute_bearing_spectrum(signal, sv, method, pool)
 
     return Position(bearing_spectrum, signal, sites, signal.t_start, signal.t_end,
                     stepsize, emin, emax, nmin, nmax)
@@ -86,7 +111,7 @@ def WindowedPositionEstimator(signal, sites, sv, t_step, t_win,
                                stepsize = STEPSIZE, emin = EASTING_MIN, emax=EASTING_MAX,
                                nmin = NORTHING_MIN, nmax = NORTHING_MAX,
                                method=signal.Signal.Bartlet, 
-                               prepare_for_cov=False):
+                               prepare_for_cov=False, pool=None):
   ''' Estimate the source of a signal for windows of data over ``signal``. 
   
     Inputs: 
@@ -106,24 +131,66 @@ def WindowedPositionEstimator(signal, sites, sv, t_step, t_win,
 
       stepsize, emin, emax, nmin, nmax -- Parameters for position estimation algorithm. 
 
+      prepare_for_cov -- keep the bearing spectrum of each pulse in the 
+                         positions (`all_spectra`), as needed for 
+                         `position_covariance.CovarianceEstimator()`. 
+
+      pool -- instance of `class signal.SpectrumPool`. If provided, the bearing 
+              spectra are computed by the pool's worker processes. 
+
     Returns a list of `class position.Position` instances. 
   ''' 
-  pos = []
-
+  return list(WindowedPositionStream(signal, sites, sv, t_step, t_win, 
+                                     stepsize, emin, emax, nmin, nmax, 
+                                     method, prepare_for_cov, pool))
+
+
+def WindowedPositionStream(signal, sites, sv, t_step, t_win, 
+                           stepsize = STEPSIZE, emin = EASTING_MIN, emax=EASTING_MAX,
+                           nmin = NORTHING_MIN, nmax = NORTHING_MAX,
+                           method=signal.Signal.Bartlet, 
+                           prepare_for_cov=False, pool=None):
+  ''' Generate position estimates for windows of data over ``signal``. 
+
+    Like `WindowedPositionEstimator()`, but positions are yielded as each
+    window is computed, so that they can be stored without holding all 
+    of them in memory. Site data are aggregated incrementally by 
+    `aggregate_windows()`. 
+  ''' 
   if len(signal) > 0: 
-    bearing_spectrum = {} # Compute bearing likelihood distributions. 
-
-    for site_id in signal.get_site_ids().intersection(sv.get_site_ids()): 
-      bearing_spectrum[site_id] = method(signal[site_id], sv)
-    
-    for (t_start, t_end) in util.compute_time_windows(
-                        signal.t_start, signal.t_end, t_step, t_win):
+    bearing_spectrum = compute_bearing_spectrum(signal, sv, method, pool)
     
-      pos.append(Position(bearing_spectrum, signal, 
-                  sites, t_start, t_end, stepsize, emin, emax, nmin, nmax,
-                  prepare_for_cov))
-    
-  return pos
+    for (t_start, t_end, aggregate) in aggregate_windows(bearing_spectrum, signal, 
+                        util.compute_time_windows(signal.t_start, signal.t_end, t_step, t_win),
+                        prepare_for_cov):
+      P = Position()
+      P.calc_aggregate(aggregate, sites, t_start, t_end, stepsize, emin, emax, nmin, nmax)
+      yield P
+
+
+def WindowedPositionEstimatorAsync(pool, signal, sites, t_step, t_win, 
+                               stepsize = STEPSIZE, emin = EASTING_MIN, emax=EASTING_MAX,
+                               nmin = NORTHING_MIN, nmax = NORTHING_MAX,
+                               method=signal.Signal.Bartlet, 
+                               prepare_for_cov=False):
+  ''' Run `WindowedPositionEstimator()` in a worker process of `pool`. 
+
+    This is used to process several deployments (or time ranges) at once. 
+    The steering vectors are those the pool was created with. Returns an 
+    object whose `get()` method blocks until the positions are computed 
+    and returns them. 
+  '''
+  return pool.apply_async(_windowed_position_task, 
+                  (signal, sites, t_step, t_win, stepsize, emin, emax, nmin, nmax, 
+                   method.__name__, prepare_for_cov))
+
+
+def _windowed_position_task(sig, sites, t_step, t_win, stepsize, emin, emax, 
+                            nmin, nmax, method_name, prepare_for_cov):
+  ''' Worker side of `WindowedPositionEstimatorAsync()`. ''' 
+  return WindowedPositionEstimator(sig, sites, signal.pool_steering_vectors(), 
+            t_step, t_win, stepsize, emin, emax, nmin, nmax, 
+            getattr(signal.Signal, method_name), prepare_for_cov)
 
 
 def InsertPositions(db_con, dep_id, cal_id, zone, pos, cov=None):
@@ -143,27 +210,37 @@ def InsertPositions(db_con, dep_id, cal_id, zone, pos, cov=None):
 
       pos -- list of `class position.Position` instances
 
-      cov -- list of `class position.BootstrapCovariance` instances 
-             corresponding to the positions in `pos`. 
+      cov -- list of `class position_covariance.BootstrapCovariance` instances 
+             corresponding to the positions in `pos`, as computed by 
+             `position_covariance.CovarianceEstimator()`. 
   
   ''' 
-  max_id = 0
-  for j in range(len(pos)):
-    P = pos[j]
-    # Insert bearings
-    bearing_ids = []
+  # Insert bearings
+  bearings = []
+  for P in pos:
     for (site_id, B) in P.bearings.iteritems():
-      bearing_id = B.insert_db(db_con, cal_id, dep_id, site_id, P.t)
-      bearing_ids.append(bearing_id)
-    
-    # Insert position
-    pos_id = P.insert_db(db_con, dep_id, bearing_ids, zone)
-    if pos_id and not (cov is None):
-      C = cov[j]
-      max_id = max(pos_id, max_id)
-      
-      # Insert covariance
-      cov_id = C.insert_db(db_con, pos_id)
+      bearings.append((site_id, P.t, B))
+  prov_args = []
+  bearing_ids = iter(insert_bearings(db_con, cal_id, dep_id, bearings, prov_args))
+  
+  # Insert positions
+  positions = []
+  for P in pos:
+    positions.append((P, [ bearing_ids.next() for _ in P.bearings ]))
+  pos_ids = insert_positions(db_con, dep_id, zone, positions, prov_args)
+
+  # Insert provenance of bearings and positions at once. 
+  insert_provenance(db_con.cursor(), prov_args, PROVENANCE_RANGES)
+  
+  max_id = 0
+  if not (cov is None):
+    for j in range(len(pos)):
+      if pos_ids[j]:
+        C = cov[j]
+        max_id = max(pos_ids[j], max_id)
+        
+        # Insert covariance
+        cov_id = C.insert_db(db_con, pos_ids[j])
   return max_id
 
 
@@ -283,17 +360,17 @@ class Position:
     self.bearings = None
     
     self.splines = None
-    self.all_splines = None
+    self.all_spectra = None
     
     self.pos_id = None
     self.zone = None
     self.latitude = None
     self.longitude = None
   
-    if len(args) == 11: 
+    if len(args) >= 10: 
       self.calc(*args)
 
-  def calc(self, bearing_spectrum, signal, sites, t_start, t_end, stepsize, emin, emax, nmin, nmax, prepare_for_cov):
+  def calc(self, bearing_spectrum, signal, sites, t_start, t_end, stepsize, emin, emax, nmin, nmax, prepare_for_cov=False):
     ''' Compute a position from signal data.
 
       In addition, compute the bearing data. If there is only data from one site, then 
@@ -318,12 +395,21 @@ class Position:
         stepsize, emin, emax, nmin, nmax -- Parameters for position estimation algorithm. 
     ''' 
     # Aggregate site data. 
-    (splines, all_splines, bearings, num_est) = aggregate_window(
-                                  bearing_spectrum, signal, t_start, t_end,
-                                  prepare_for_cov)
+    self.calc_aggregate(aggregate_window(bearing_spectrum, signal, t_start, t_end, 
+                                         prepare_for_cov), 
+                        sites, t_start, t_end, stepsize, emin, emax, nmin, nmax)
+
+  def calc_aggregate(self, aggregate, sites, t_start, t_end, stepsize, emin, emax, nmin, nmax):
+    ''' Compute a position from site data aggregated over a window.
+      
+      `aggregate` is the result of `aggregate_window()` for the window 
+      (t_start, t_end). Other inputs are as for `position.Position.calc()`. 
+    ''' 
+    (splines, all_spectra, bearings, num_est, spectra) = aggregate
    
     if len(splines) > 1: # Need at least two site bearings. 
-      p_hat, likelihood = compute_position(sites, splines, stepsize, emin, emax, nmin, nmax)
+      p_hat, likelihood = compute_position(sites, splines, stepsize, emin, emax, nmin, nmax,
+                                           spectra)
     else: p_hat, likelihood = None, None
     
     # Return a position object. 
@@ -347,7 +433,7 @@ class Position:
     self.num_sites = num_sites
 
     self.splines = splines         # siteID -> aggregated bearing likelihood spline
-    self.all_splines = all_splines # siteID -> spline for each pulse
+    self.all_spectra = all_spectra # siteID -> bearing spectrum of each pulse
 
  
   def insert_db(self, db_con, dep_id, bearing_ids, zone):
@@ -361,24 +447,7 @@ class Position:
                        corresponding to bearing data. These are used for provenance 
                        in the database. 
     ''' 
-    if self.p is None: 
-      return None
-    number, letter = zone
-    lat, lon = utm.to_latlon(self.p.imag, self.p.real, number, letter)
-    cur = db_con.cursor()
-    cur.execute('''INSERT INTO position
-                     (deploymentID, timestamp, latitude, longitude, easting, northing, 
-                      utm_zone_number, utm_zone_letter, likelihood, 
-                      activity, number_est_used)
-                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)''',
-                     (dep_id, self.t, round(lat,6), round(lon,6),
-                      self.p.imag, self.p.real, number, letter, 
-                      self.likelihood, self.activity,
-                      self.num_est))
-    pos_id = cur.lastrowid
-    handle_provenance_insertion(cur, {'bearing': tuple(bearing_ids)}, 
-                                     {'position' : (pos_id,)})
-    return pos_id
+    return insert_positions(db_con, dep_id, zone, [(self, bearing_ids)])[0]
 
   def plot(self, fn, dep_id, sites, center, p_known=None, half_span=150, scale=10):
     ''' Plot search space of position estimate. 
@@ -506,39 +575,44 @@ class Bearing:
           
         t -- Unix timestamp in GMT. 
     ''' 
-    cur = db_con.cursor()
-    cur.execute('''INSERT INTO bearing 
-                          (deploymentID, siteID, timestamp, 
-                           bearing, likelihood, activity, number_est_used)
-                  VALUES (%s, %s, %s, %s, %s, %s, %s)''', 
-                 (dep_id, site_id, t, 
-                  self.bearing, self.likelihood, self.activity, self.num_est))
-    bearing_id = cur.lastrowid
-    handle_provenance_insertion(cur, {'est' : tuple(self.est_ids), 
-                                       'calibration_information' : (cal_id,)}, 
-                                      {'bearing' : (bearing_id,)})
-    return bearing_id
+    return insert_bearings(db_con, cal_id, dep_id, [(site_id, t, self)])[0]
 
 
 
 
 ### Low level calls. ##########################################################
+
+def compute_bearing_spectrum(signal, sv, method, pool=None):
+  ''' Compute the bearing spectrum of each site in both `signal` and `sv`. 
+  
+    Returns a mapping from siteIDs to bearing spectra. 
+  '''
+  if pool is not None: 
+    return pool.spectrum(signal, method)
+  bearing_spectrum = {}
+  for site_id in signal.get_site_ids().intersection(sv.get_site_ids()): 
+    bearing_spectrum[site_id] = method(signal[site_id], sv)
+  return bearing_spectrum
+
 def aggregate_window(bearing_spectrum_per_site_dict, signal_per_site_dict, t_start, t_end,
-                     calc_all_splines=False):
+                     calc_all_spectra=False):
   ''' Aggregate site data, compute splines for pos. estimation. 
   
     Site data includes the most likely bearing to each site, 
-    measurement of activity at each site, and a spline 
-    interpolation of bearing distribution at each site. 
+    measurement of activity at each site, the aggregated bearing 
+    spectrum of each site, and a spline interpolation of it. If 
+    `calc_all_spectra` is set, the bearing spectrum of each pulse is 
+    kept as well, for covariance estimation (see `position_covariance`). 
   '''
 
   num_est = 0
+  spectra = {}
   splines = {}  
   bearings = {}
 
-  if calc_all_splines: 
-    all_splines = {}
-  else: all_splines = None
+  if calc_all_spectra: 
+    all_spectra = {}
+  else: all_spectra = None
 
   for (siteID, bearing_spectrum) in bearing_spectrum_per_site_dict.iteritems():
     mask = (t_start <= signal_per_site_dict[siteID].t) & (signal_per_site_dict[siteID].t < t_end)
@@ -548,20 +622,90 @@ def aggregate_window(bearing_spectrum_per_site_dict, signal_per_site_dict, t_sta
       likelihoods = bearing_spectrum[mask]
       # Aggregated bearing spectrum spline per site.
       spectrum = aggregate_spectrum(likelihoods)
+      spectra[siteID] = spectrum
       splines[siteID] = compute_bearing_spline(spectrum)
       
-      # All splines.
-      if calc_all_splines: 
-        all_splines[siteID] = []
-        for i in range(len(likelihoods)):
-          all_splines[siteID].append(compute_bearing_spline(likelihoods[i]))
+      # All spectra.
+      if calc_all_spectra: 
+        all_spectra[siteID] = likelihoods
 
       # Aggregated data per site.
       bearings[siteID] = Bearing(edsp, spectrum, est_ids)
 
       num_est += edsp.shape[0]
   
-  return (splines, all_splines, bearings, num_est)
+  return (splines, all_spectra, bearings, num_est, spectra)
+
+
+def aggregate_windows(bearing_spectrum_per_site_dict, signal_per_site_dict, windows, 
+                      calc_all_spectra=False):
+  ''' Aggregate site data over a sequence of windows. 
+
+    This is a generator yielding `(t_start, t_end, aggregate)` for each 
+    `(t_start, t_end)` in `windows`, where `aggregate` is the result of
+    `aggregate_window()` for the window. Window boundaries must be 
+    non-decreasing, as they are for `util.compute_time_windows()`. Instead
+    of masking the data and summing the spectra of each window, a running 
+    sum of the spectra is kept for each site: pulses are added as the window 
+    advances past them and removed as the window leaves them behind. (If 
+    more pulses would be removed than are left, the sum is recomputed.)
+    Aggregation is thus linear in the number of pulses rather than 
+    proportional to the number of windows each pulse is in. 
+  '''
+  
+  sites = {} # siteID -> (t, edsp, est_ids, bearing spectrum)
+  for (siteID, bearing_spectrum) in bearing_spectrum_per_site_dict.iteritems():
+    site = signal_per_site_dict[siteID]
+    (t, edsp, est_ids) = (site.t, site.edsp, site.est_ids)
+    if np.any(np.diff(t) < 0): # Signal data are normally sorted by time.  
+      i = np.argsort(t, kind='mergesort')
+      (t, edsp, est_ids, bearing_spectrum) = (t[i], edsp[i], est_ids[i], bearing_spectrum[i])
+    sites[siteID] = (t, edsp, est_ids, bearing_spectrum)
+  
+  lo = dict((siteID, 0) for siteID in sites.keys())
+  hi = dict((siteID, 0) for siteID in sites.keys())
+  total = dict((siteID, np.zeros(360, dtype=np.float64)) for siteID in sites.keys())
+
+  for (t_start, t_end) in windows:
+    num_est = 0
+    spectra = {}
+    splines = {}  
+    bearings = {}
+    
+    if calc_all_spectra: 
+      all_spectra = {}
+    else: all_spectra = None
+
+    for (siteID, (t, edsp, est_ids, bearing_spectrum)) in sites.iteritems():
+      i = max(lo[siteID], np.searchsorted(t, t_start, side='left'))
+      j = max(hi[siteID], np.searchsorted(t, t_end, side='left'))
+      if (i - lo[siteID]) >= (j - i): 
+        total[siteID] = np.sum(bearing_spectrum[i:j], 0)
+      else:
+        total[siteID] += np.sum(bearing_spectrum[hi[siteID]:j], 0)
+        total[siteID] -= np.sum(bearing_spectrum[lo[siteID]:i], 0)
+      (lo[siteID], hi[siteID]) = (i, j)
+      
+      if j > i: 
+        likelihoods = bearing_spectrum[i:j]
+        # Aggregated bearing spectrum spline per site.
+        if NORMALIZE_SPECTRUM: 
+          spectrum = total[siteID] / (j - i)
+        else: 
+          spectrum = total[siteID].copy()
+        spectra[siteID] = spectrum
+        splines[siteID] = compute_bearing_spline(spectrum)
+        
+        # All spectra.
+        if calc_all_spectra: 
+          all_spectra[siteID] = likelihoods
+
+        # Aggregated data per site.
+        bearings[siteID] = Bearing(edsp[i:j], spectrum, est_ids[i:j])
+
+        num_est += j - i
+  
+    yield (t_start, t_end, (splines, all_spectra, bearings, num_est, spectra))
 
 
 def aggregate_spectrum(p):
@@ -583,17 +727,26 @@ def compute_bearing_spline(l):
   return spline1d(bearing_domain, likelihood_range)
 
 
-def compute_likelihood_grid(sites, splines, stepsize, emin, emax, nmin, nmax):
-  ''' Compute a grid of candidate points and their likelihoods. '''
-  # Generate a grid of positions with center at the center. 
+def compute_grid(stepsize, emin, emax, nmin, nmax):
+  ''' Return the grid of candidate points as complex numbers. 
+  
+    Rows correspond to eastings and columns to northings. 
+  '''
   e_range = np.arange(emin,emax+stepsize,stepsize)
   n_range = np.arange(nmin,nmax+stepsize,stepsize)
-  positions = np.zeros((len(e_range), len(n_range)),np.complex)
-  for j,e in enumerate(e_range):
-    for k,n in enumerate(n_range):
-      positions[j, k] = np.complex(n, e)
-  # Compute the likelihood of each position as the sum of the likelihoods 
-  # of bearing to each site. 
+  return n_range[np.newaxis,:] + (np.complex(0,1) * e_range[:,np.newaxis])
+
+def compute_likelihood_grid(sites, splines, stepsize, emin, emax, nmin, nmax):
+  ''' Compute a grid of candidate points and their likelihoods. '''
+  positions = compute_grid(stepsize, emin, emax, nmin, nmax)
+  return (positions, compute_likelihoods(sites, splines, positions))
+
+def compute_likelihoods(sites, splines, positions):
+  ''' Compute the likelihood of an array of positions. 
+  
+    The likelihood of a position is the sum of the likelihoods of the 
+    bearing to each site. 
+  '''
   likelihoods = np.zeros(positions.shape, dtype=float)
   for siteID in splines.keys():
     bearing_to_positions = np.angle(positions - sites[siteID]) * 180 / np.pi
@@ -604,7 +757,7 @@ def compute_likelihood_grid(sites, splines, stepsize, emin, emax, nmin, nmax):
     else:
       for s in spline_iter:
         likelihoods += s(bearing_to_positions.flat).reshape(bearing_to_positions.shape)
-  return (positions, likelihoods)
+  return likelihoods
 
 #not called TAB 2015-07-27
 def compute_likelihood(sites, splines, p):
@@ -615,12 +768,16 @@ def compute_likelihood(sites, splines, p):
     likelihood += splines[siteID](bearing)
   return likelihood
 
-def compute_position(sites, splines, stepsize, emin, emax, nmin, nmax):
+def compute_position(sites, splines, stepsize, emin, emax, nmin, nmax, spectra=None):
   ''' Maximize over position space. 
 
     Grid search algorithm for position estimation.  First pass is stepsize grid
     within boundry.  Second pass is 1 meter grid bounding the likelihoods > 90% max
-    of first pass.
+    of first pass. If `spectra` is provided and `COARSE_LOOKUP` is set, the 
+    first pass looks up the spectra on a cached `SearchGrid` instead of 
+    evaluating the splines. If `SEARCH_METHOD` is 'pyramid', then 
+    `compute_position_pyramid()` is used instead, starting with `stepsize`
+    and refining through the finer of `SEARCH_LEVELS`. 
 
     Inputs: 
       
@@ -632,12 +789,23 @@ def compute_position(sites, splines, stepsize, emin, emax, nmin, nmax):
       stepsize -- initial stepsize for grid search
 
       emin, emax, nmin, nmax -- initial grid boundary for search
+
+      spectra -- aggregated bearing spectra (360 bins) from which `splines` 
+                 were interpolated. 
     
       Returns UTM position estimate as a complex number and the likelihood
       of the position
   '''
+  if SEARCH_METHOD == 'pyramid':
+    return compute_position_pyramid(sites, splines, emin, emax, nmin, nmax, spectra,
+                                    [stepsize] + SEARCH_LEVELS)
   
-  (positions, likelihoods) = compute_likelihood_grid(
+  if spectra is not None and COARSE_LOOKUP:
+    grid = get_search_grid(sites, stepsize, emin, emax, nmin, nmax)
+    positions = grid.positions
+    likelihoods = grid.likelihoods(spectra, COARSE_LOOKUP)
+  else: 
+    (positions, likelihoods) = compute_likelihood_grid(
                              sites, splines, stepsize, emin, emax, nmin, nmax)
   max_llh = np.max(likelihoods)
   select_positions = positions[likelihoods > 0.9*max_llh]
@@ -653,16 +821,316 @@ def compute_position(sites, splines, stepsize, emin, emax, nmin, nmax):
   return p_hat, max_llh
 
 
+def compute_position_pyramid(sites, splines, emin, emax, nmin, nmax, spectra=None,
+                             levels=None, seeds=None, max_points=None):
+  ''' Maximize over position space by coarse-to-fine search. 
 
+    The first level is a grid over the search space with step `levels[0]`. 
+    Its local maxima are ranked and the best `seeds` of them are kept. At 
+    each following level, a grid with step `levels[i]` is evaluated over 
+    the square of half-width `levels[i-1]` around each seed, and the best 
+    `seeds` points become the seeds of the next level. At most `max_points`
+    points are evaluated: the step of the first level is enlarged if need 
+    be so that its grid takes at most half of them, the following levels 
+    that are no finer than the first are skipped, and fewer seeds are kept 
+    at them if needed. The cost of an estimate thus depends on 
+    the parameters, not on the shape of the likelihood surface. 
 
-def handle_provenance_insertion(cur, depends_on, obj):
-  ''' Insert provenance data into database ''' 
-  query = 'insert into provenance (obj_table, obj_id, dep_table, dep_id) values (%s, %s, %s, %s);'
+    Inputs are as for `compute_position()`; `levels`, `seeds` and 
+    `max_points` default to `SEARCH_LEVELS`, `SEARCH_SEEDS` and 
+    `SEARCH_MAX_POINTS`. 
+
+    Returns UTM position estimate as a complex number and the likelihood
+    of the position. 
+  '''
+  if levels is None: levels = SEARCH_LEVELS
+  if seeds is None: seeds = SEARCH_SEEDS
+  if max_points is None: max_points = SEARCH_MAX_POINTS
+
+  # Enlarge the first level to fit the budget. 
+  step = levels[0]
+  grid_size = lambda(step) : (len(np.arange(emin, emax+step, step)) * 
+                              len(np.arange(nmin, nmax+step, step)))
+  step = max(step, np.sqrt(float(emax - emin) * (nmax - nmin) / (max_points / 2)))
+  while grid_size(step) > max_points / 2: 
+    step *= 1.05
+  levels = [step] + filter(lambda(l) : l < step, levels[1:])
+
+  if spectra is not None and COARSE_LOOKUP:
+    grid = get_search_grid(sites, levels[0], emin, emax, nmin, nmax)
+    positions = grid.positions
+    likelihoods = grid.likelihoods(spectra, COARSE_LOOKUP)
+  else: 
+    (positions, likelihoods) = compute_likelihood_grid(
+                             sites, splines, levels[0], emin, emax, nmin, nmax)
+  evaluated = positions.size
+  
+  # Seeds are the local maxima of the first level. 
+  padded = np.pad(likelihoods, 1, mode='constant', constant_values=-np.inf)
+  peak = np.ones(likelihoods.shape, dtype=bool)
+  (a, b) = likelihoods.shape
+  for (i, j) in itertools.product(range(3), range(3)): 
+    peak &= likelihoods >= padded[i:i+a, j:j+b]
+  positions = positions[peak]
+  likelihoods = likelihoods[peak]
+  
+  for k in range(1, len(levels)):
+    n = 2 * int(round(float(levels[k-1]) / levels[k])) + 1
+    offsets = np.linspace(-levels[k-1], levels[k-1], n)
+    offsets = (offsets[np.newaxis,:] + (np.complex(0,1) * offsets[:,np.newaxis])).ravel()
+    ct = min(seeds, (max_points - evaluated) / len(offsets), len(positions))
+    if ct < 1: 
+      break
+    best = positions[np.argsort(likelihoods)[-ct:]]
+    candidates = np.unique((best[:,np.newaxis] + offsets[np.newaxis,:]).ravel())
+    candidates = candidates[(emin <= candidates.imag) & (candidates.imag <= emax) &
+                            (nmin <= candidates.real) & (candidates.real <= nmax)]
+    if len(candidates) == 0: 
+      break
+    positions = candidates
+    likelihoods = compute_likelihoods(sites, splines, positions)
+    evaluated += len(positions)
+  
+  i = np.argmax(likelihoods)
+  return positions.flat[i], likelihoods.flat[i]
+
+
+
+
+### class SearchGrid. #########################################################
+
+# Search grids that have been built, keyed by sites and grid parameters. 
+_search_grids = {}
+
+def get_search_grid(sites, stepsize, emin, emax, nmin, nmax):
+  ''' Return a cached `SearchGrid`, building it on first use. '''
+  key = (tuple(sorted(sites.iteritems())), stepsize, emin, emax, nmin, nmax)
+  grid = _search_grids.get(key)
+  if grid is None: 
+    grid = _search_grids[key] = SearchGrid(sites, stepsize, emin, emax, nmin, nmax)
+  return grid
+
+
+class SearchGrid: 
+
+  def __init__(self, sites, stepsize=STEPSIZE, emin=EASTING_MIN, emax=EASTING_MAX,
+                     nmin=NORTHING_MIN, nmax=NORTHING_MAX):
+    ''' Coarse grid of candidate positions and bearings to them. 
+
+      The grid and the site locations don't change during a run, so the 
+      positions and the bearing from each site to each position are 
+      computed once. Bearings are stored as an index into a 360-bin 
+      bearing spectrum and the fractional part for linear interpolation. 
+
+      Inputs: 
+
+        sites -- mapping from siteIDs to receiver locations. 
+
+        stepsize, emin, emax, nmin, nmax -- grid parameters, as for 
+                                            `compute_likelihood_grid()`. 
+    '''
+    self.positions = compute_grid(stepsize, emin, emax, nmin, nmax)
+    self.index = {}  # site.ID -> bin of bearing to position
+    self.weight = {} # site.ID -> fraction of the way to the next bin
+    self.nearest = {} # site.ID -> nearest bin, computed on first use
+    for (site_id, site) in sites.iteritems():
+      bearing = np.mod(np.angle(self.positions - site) * 180 / np.pi, 360)
+      index = np.floor(bearing)
+      self.weight[site_id] = bearing - index
+      self.index[site_id] = index.astype(np.int32) % 360
+
+  def likelihoods(self, spectra, interpolation='linear'):
+    ''' Compute the likelihood of each position on the grid. 
+
+      Input: 
+
+        spectra -- mapping from siteIDs to bearing spectra, arrays of 360
+                   likelihoods indexed by whole-degree bearing. The value 
+                   may also be a list of spectra, which are summed. 
+
+        interpolation -- 'linear' or 'nearest'. 
+
+      Returns an array of likelihoods with the same shape as `positions`. 
+    '''
+    likelihoods = np.zeros(self.positions.shape, dtype=float)
+    for (site_id, spectrum) in spectra.iteritems():
+      spectrum = np.asarray(spectrum, dtype=float)
+      if spectrum.ndim > 1: 
+        spectrum = np.sum(spectrum, 0)
+      if interpolation == 'nearest': 
+        if self.nearest.get(site_id) is None:
+          i = self.index[site_id]
+          self.nearest[site_id] = np.where(self.weight[site_id] < 0.5, i, (i + 1) % 360)
+        likelihoods += np.take(spectrum, self.nearest[site_id])
+      else:
+        i = self.index[site_id]
+        slope = np.roll(spectrum, -1) - spectrum
+        likelihoods += np.take(spectrum, i) + (self.weight[site_id] * np.take(slope, i))
+    return likelihoods
+
+
+def insert_bearings(db_con, cal_id, dep_id, bearings, prov_args=None):
+  ''' Insert bearings and their provenance into the database. 
+
+    Inputs: 
+
+      db_con, cal_id, dep_id
+
+      bearings -- list of (siteID, timestamp, `class position.Bearing`). 
+
+      prov_args -- if given, provenance records are appended to this list
+                   instead of being inserted (see `insert_provenance()`). 
+
+    Returns the bearingIDs, in the same order. 
+  ''' 
+  cur = db_con.cursor()
+  bearing_ids = util.insert_many(cur, '''INSERT INTO bearing 
+                                         (deploymentID, siteID, timestamp, 
+                                          bearing, likelihood, activity, number_est_used)
+                                        VALUES''', 
+    [ (dep_id, site_id, t, B.bearing, B.likelihood, B.activity, B.num_est) 
+      for (site_id, t, B) in bearings ])
+  records = []
+  for (bearing_id, (site_id, t, B)) in zip(bearing_ids, bearings):
+    records += get_provenance_args({'est' : tuple(B.est_ids), 
+                                    'calibration_information' : (cal_id,)}, 
+                                   {'bearing' : (bearing_id,)}, PROVENANCE_RANGES)
+  if prov_args is None: 
+    insert_provenance(cur, records, PROVENANCE_RANGES)
+  else: 
+    prov_args += records
+  return bearing_ids
+
+
+def insert_positions(db_con, dep_id, zone, positions, prov_args=None):
+  ''' Insert positions and their provenance into the database. 
+
+    Inputs: 
+
+      db_con, dep_id, zone
+
+      positions -- list of (`class position.Position`, bearingIDs), where 
+                   the bearingIDs are of the bearings from which the 
+                   position was computed. 
+
+      prov_args -- if given, provenance records are appended to this list
+                   instead of being inserted (see `insert_provenance()`). 
+
+    Returns the positionIDs, in the same order. Positions that weren't 
+    estimated aren't inserted and their ID is None. 
+  ''' 
+  (number, letter) = zone
+  rows = []; inserted = []
+  for (P, bearing_ids) in positions:
+    if P.p is None: 
+      continue
+    lat, lon = utm.to_latlon(P.p.imag, P.p.real, number, letter)
+    rows.append((dep_id, P.t, round(lat,6), round(lon,6),
+                 P.p.imag, P.p.real, number, letter, 
+                 P.likelihood, P.activity, P.num_est))
+    inserted.append(bearing_ids)
+  
+  cur = db_con.cursor()
+  ids = util.insert_many(cur, '''INSERT INTO position
+                                 (deploymentID, timestamp, latitude, longitude, easting, northing, 
+                                  utm_zone_number, utm_zone_letter, likelihood, 
+                                  activity, number_est_used)
+                                VALUES''', rows)
+  records = []
+  for (pos_id, bearing_ids) in zip(ids, inserted):
+    records += get_provenance_args({'bearing': tuple(bearing_ids)}, 
+                                   {'position' : (pos_id,)}, PROVENANCE_RANGES)
+  if prov_args is None: 
+    insert_provenance(cur, records, PROVENANCE_RANGES)
+  else: 
+    prov_args += records
+
+  ids = iter(ids)
+  return [ None if P.p is None else ids.next() for (P, _) in positions ]
+
+
+def get_provenance_args(depends_on, obj, ranges=False):
+  ''' Return provenance records (obj_table, obj_id, dep_table, dep_id). 
+
+    If `ranges` is True, return range-encoded records (obj_table, obj_id, 
+    dep_table, dep_start, dep_end) instead, one for each contiguous run 
+    of dependency IDs (see `id_ranges()`). 
+  ''' 
   prov_args = []
   for dep_k in depends_on.keys():
-    for dep_v in depends_on[dep_k]:
+    dep_vals = id_ranges(depends_on[dep_k]) if ranges else depends_on[dep_k]
+    for dep_v in dep_vals:
       for obj_k in obj.keys():
         for obj_v in obj[obj_k]:
-          args = (obj_k, obj_v, dep_k, dep_v)
+          if ranges: 
+            args = (obj_k, obj_v, dep_k, dep_v[0], dep_v[1])
+          else: 
+            args = (obj_k, obj_v, dep_k, dep_v)
           prov_args.append(args)
-  cur.executemany(query, prov_args) 
+  return prov_args
+
+
+def id_ranges(ids): 
+  ''' Return the contiguous runs of a set of IDs as inclusive ranges, e.g. 
+    [5, 1, 2, 3, 7, 6, 9] -> [(1, 3), (5, 7), (9, 9)]. ''' 
+  ids = np.unique(np.asarray(ids, dtype=np.int64))
+  if len(ids) == 0: 
+    return []
+  breaks = np.flatnonzero(np.diff(ids) != 1)
+  starts = np.concatenate(([ids[0]], ids[breaks + 1]))
+  ends = np.concatenate((ids[breaks], [ids[-1]]))
+  return zip(starts.tolist(), ends.tolist())
+
+
+def insert_provenance(cur, prov_args, ranges=False):
+  ''' Insert provenance records into database. Range-encoded records 
+    (see `get_provenance_args()`) are inserted into `provenance_range`. ''' 
+  if ranges: 
+    util.insert_many(cur, '''INSERT INTO provenance_range 
+                               (obj_table, obj_id, dep_table, dep_start, dep_end) 
+                             VALUES''', prov_args)
+  else:
+    util.insert_many(cur, '''INSERT INTO provenance (obj_table, obj_id, dep_table, dep_id) 
+                             VALUES''', prov_args)
+
+
+def read_provenance(db_con, obj_table, obj_ids): 
+  ''' Read the dependencies of objects from the database. 
+
+    Both encodings are read, `provenance` and `provenance_range`, and 
+    ranges are expanded. 
+
+    Inputs: 
+
+      db_con, obj_table (e.g. 'position')
+
+      obj_ids -- IDs of the objects. 
+
+    Returns a dictionary mapping each object ID to a dictionary mapping 
+    dependency tables to the sorted list of dependency IDs. 
+  ''' 
+  deps = dict((obj_id, {}) for obj_id in obj_ids)
+  if len(deps) == 0:
+    return deps
+  cur = db_con.cursor()
+  args = [obj_table] + deps.keys()
+  where = 'WHERE obj_table = %s AND obj_id IN (' + ', '.join(['%s'] * len(deps)) + ')'
+  
+  cur.execute('SELECT obj_id, dep_table, dep_id FROM provenance ' + where, args)
+  for (obj_id, dep_table, dep_id) in cur.fetchall():
+    deps[obj_id].setdefault(dep_table, []).append(dep_id)
+  
+  cur.execute('SELECT obj_id, dep_table, dep_start, dep_end FROM provenance_range ' + where, args)
+  for (obj_id, dep_table, dep_start, dep_end) in cur.fetchall():
+    deps[obj_id].setdefault(dep_table, []).extend(range(dep_start, dep_end + 1))
+
+  for obj_deps in deps.values():
+    for dep_ids in obj_deps.values():
+      dep_ids.sort()
+  return deps
+
+
+def handle_provenance_insertion(cur, depends_on, obj):
+  ''' Insert provenance data into database ''' 
+  insert_provenance(cur, get_provenance_args(depends_on, obj, PROVENANCE_RANGES), 
+                    PROVENANCE_RANGES)
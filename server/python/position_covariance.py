@@ -1,10 +1,61 @@
-
-#TODO import statements
+# position_covariance.py -- Covariance and confidence regions of position 
+# estimates. 
+#
+# High level calls, database interaction: 
+#  - CovarianceEstimator
+#  - ReadCovariances
+#  - ReadConfidenceRegions
+#
+# Objects defined here: 
+#  - class Ellipse
+#  - class Covariance
+#  - class BootstrapCovariance
+#  - class BootstrapCovariance2
+#  - class BootstrapCovariance3
+
+from . import position
+
+import numpy as np
+import itertools
+import scipy.stats
+from scipy.special import gammaln
 
 # Paramters for bootstrap covariance estimation. 
 BOOT_MAX_RESAMPLES = 200
 BOOT_CONF_LEVELS = [0.68, 0.80, 0.90, 0.95, 0.997]
 
+# Resamples are drawn from the enumeration of the distinct combinations of 
+# resamples if there are fewer than this many times the number of resamples. 
+BOOT_ENUMERATE_RATIO = 4
+
+# Solver for the position estimates of the resamples. These are usually 
+# within tens of meters of the position estimate, so they are searched for 
+# in the square of half-width `BOOT_LOCAL_SPAN` around it. 'grid' is a grid 
+# with step `BOOT_LEVELS[0]` (meters) over the square, refined through the 
+# remaining levels as in `position.compute_position_pyramid()`. 'newton' 
+# starts from the best point of the first level and takes at most 
+# `BOOT_NEWTON_STEPS` steps of Newton's method, until they are shorter than 
+# `BOOT_NEWTON_TOL`. 
+BOOT_SOLVER = 'newton'
+BOOT_LOCAL_SPAN = 100
+BOOT_LEVELS = [5, 1, 0.5]
+BOOT_NEWTON_STEPS = 10
+BOOT_NEWTON_TOL = 0.01
+
+# Resamples whose estimate is on the edge of the local square are searched 
+# for again with 'grid' in the square of half-width `BOOT_SPAN`. If the best 
+# point is on the edge of that square, the square is moved there and searched 
+# again, at most `BOOT_MAX_SHIFTS` times. 
+BOOT_SPAN = 200
+BOOT_MAX_SHIFTS = 4
+
+# Maximum number of pulse likelihoods computed at once by the search. 
+BOOT_BLOCK_SIZE = 2 ** 22
+
+# Asymptotic covariance. This relies on data that `class position.Position` 
+# doesn't keep. 
+ENABLE_ASYMPTOTIC = False
+
 
 ### class PositionEstimator. ##################################################
 
@@ -25,37 +76,44 @@ class BootstrapError (PositionError):
   msg = 'not enough samples to perform boostrap.'
 
 
-#TODO impliment the correct calls to agragate spectrum
-if False:
-  if ENABLE_BOOTSTRAP3 or ENABLE_ASYMPTOTIC: 
-    all_splines = {}
-  else: all_splines = None
-
-  if ENABLE_BOOTSTRAP or ENABLE_BOOTSTRAP2:
-    sub_splines = {}
-  else: sub_splines = None
-
 
-
-def CovarianceEstimator(pos, sites, max_resamples=BOOT_MAX_RESAMPLES):  
+def CovarianceEstimator(pos, sites, max_resamples=BOOT_MAX_RESAMPLES, pool=None):  
   ''' Compute covariance of each position in `pos`. 
 
     Inputs:
       
-      pos -- list of `class position.Position` instances. 
+      pos -- list of `class position.Position` instances, computed with 
+             `prepare_for_cov` set so that they keep the bearing spectrum 
+             of each pulse. 
 
       sites -- mapping of siteIDs to receiver locations. 
 
       max_resamples -- a paramter of the bootstrap covariance estimate, the 
                        number of times to resample from the data. 
 
-    Returns a list of `position.BootstrapCovariance` instances. 
+      pool -- an object with an `apply_async()` method, such as an instance of 
+              `class signal.SpectrumPool` or `multiprocessing.Pool`. If 
+              provided, the positions are handed out to its worker processes. 
+              The resamples are drawn here, so the workers don't share a 
+              random state. 
+
+    Returns a list of `class position_covariance.BootstrapCovariance3` instances. 
   ''' 
-  cov = []
+  if pool is None: 
+    return [ BootstrapCovariance3(P, sites, max_resamples) for P in pos ]
+  
+  results = []
   for P in pos:
-    C = BootstrapCovariance3(P, sites, max_resamples)
-    cov.append(C)
-  return cov
+    # Send only what's needed for the estimate. 
+    Q = position.Position()
+    (Q.p, Q.num_sites, Q.all_spectra) = (P.p, P.num_sites, P.all_spectra)
+    results.append(pool.apply_async(_covariance_task, 
+                        (Q, sites, max_resamples, bootstrap_case_counts(Q, max_resamples))))
+  return [ result.get() for result in results ]
+
+def _covariance_task(pos, sites, max_resamples, counts):
+  ''' Worker side of `CovarianceEstimator()`. '''
+  return BootstrapCovariance3(pos, sites, max_resamples, counts)
 
 def ReadCovariances(db_con, dep_id, t_start, t_end):
   ''' Read covariances from the database. 
@@ -77,8 +135,10 @@ def ReadCovariances(db_con, dep_id, t_start, t_end):
   for row in cur.fetchall():
     if row[1] == 'boot':
       C = BootstrapCovariance()
-    elif row[2] == 'boot2': 
+    elif row[1] == 'boot2': 
       C = BootstrapCovariance2()
+    elif row[1] == 'boot3': 
+      C = BootstrapCovariance3()
     if row[0] == 'ok':
       C.C = np.array([[row[2], row[3]], 
                       [row[4], row[5]]])
@@ -208,6 +268,7 @@ class Ellipse:
 
   def plot(self, fn, p_known=None):
     ''' A pretty plot of confidence region. ''' 
+    import matplotlib.pyplot as pp
     pp.rc('text', usetex=True)
     pp.rc('font', family='serif')
     
@@ -289,8 +350,9 @@ class Covariance:
       Note that this expression only works if the `NORMALIZE_SPECTRUM` flag at the
       top of this program is set to `True`. 
     ''' 
-    assert NORMALIZE_SPECTRUM
+    assert position.NORMALIZE_SPECTRUM
     assert ENABLE_ASYMPTOTIC
+    import numdifftools as nd
   
     self.p_hat = pos.p
     self.half_span = half_span
@@ -316,7 +378,7 @@ class Covariance:
     # Gradient TODO TAB
     B = np.zeros((2,2), dtype=np.float64)
     for i in range(self.m):
-      splines = { id : p[i] for (id, p) in pos.all_splines.iteritems() }
+      splines = { id : position.compute_bearing_spline(p[i]) for (id, p) in pos.all_spectra.iteritems() }
       likelihood = likelihood_function(sites, splines)
       #(positions, likelihoods) = compute_likelihood_grid(
       #                         sites, splines, p, scale, half_span)
@@ -368,19 +430,18 @@ class BootstrapCovariance (Covariance):
 
         max_resamples -- number of times to resample the data.
     '''
-    assert ENABLE_BOOTSTRAP
     self.p_hat = pos.p
 
     # Generate sub samples.
     P = np.array(bootstrap_resample_sites(pos, sites, 
-                                  max_resamples, pos.objective_function, pos.splines.keys()))
+                                  max_resamples, pos.all_spectra.keys()))
     if len(P) > 0:  
       A = np.array(P[len(P)/2:])
       B = np.array(P[:len(P)/2])
      
       # Estimate covariance. 
       self.C = np.cov(np.imag(A), np.real(A))
-      n = sum(map(lambda l : len(l), pos.sub_splines.values())) 
+      n = sum(map(lambda l : len(l), pos.all_spectra.values())) 
       self.m = float(n) / pos.num_sites
       
       # Mahalanobis distance of remaining estimates. 
@@ -485,11 +546,10 @@ class BootstrapCovariance2 (BootstrapCovariance):
       self.calc(*args, **kwargs)
 
   def calc(self, pos, sites, max_resamples=BOOT_MAX_RESAMPLES):
-    assert ENABLE_BOOTSTRAP2
     self.p_hat = pos.p
 
     # Generate sub samples.
-    P = np.array(bootstrap_resample(pos, sites, max_resamples, pos.objective_function))
+    P = np.array(bootstrap_resample(pos, sites, max_resamples))
     
     if len(P) > 0: 
       A = np.array(P[len(P)/2:])
@@ -497,7 +557,7 @@ class BootstrapCovariance2 (BootstrapCovariance):
       
       # Estimate covariance. 
       self.C = np.cov(np.imag(A), np.real(A)) 
-      n = sum(map(lambda l : len(l), pos.sub_splines.values())) 
+      n = sum(map(lambda l : len(l), pos.all_spectra.values())) 
       self.m = float(n) / pos.num_sites
       
       # Mahalanobis distance of remaining estimates. 
@@ -539,42 +599,45 @@ class BootstrapCovariance3 (BootstrapCovariance):
     if len(args) >= 2: 
       self.calc(*args, **kwargs)
 
-  def calc(self, pos, sites, max_resamples=BOOT_MAX_RESAMPLES):
-    assert ENABLE_BOOTSTRAP3
+  def calc(self, pos, sites, max_resamples=BOOT_MAX_RESAMPLES, counts=None):
+    ''' Bootstrap estimation of covariance by case resampling. 
+
+      Inputs are as for `position_covariance.BootstrapCovariance.calc()`; 
+      `counts` are the resamples, as drawn by `bootstrap_case_counts()`. 
+      If `None`, they are drawn here. 
+    '''
     self.p_hat = pos.p
 
     # Generate sub samples.
-    resampled_positions = np.array(bootstrap_case_resample(pos, sites, max_resamples, pos.objective_function))
+    self.fit(np.array(bootstrap_case_resample(pos, sites, max_resamples, counts)))
+
+  def fit(self, resampled_positions): 
+    ''' Estimate covariance and confidence levels from the position estimates
+      of the resamples, an array of complex numbers. '''
     num_resampled_positions = len(resampled_positions)
     if num_resampled_positions > 1:
       if num_resampled_positions > 100:
-        A = np.array(resampled_positions[num_resampled_positions/2:])
-        B = np.array(resampled_positions[:num_resampled_positions/2])
+        A = resampled_positions[num_resampled_positions/2:]
+        B = resampled_positions[:num_resampled_positions/2]
       else:
-        A = np.array(resampled_positions)
-        B = np.array(resampled_positions)
+        A = resampled_positions
+        B = resampled_positions
       
       # Estimate covariance. 
       self.C = np.cov(np.imag(A), np.real(A)) 
-      #n = sum(map(lambda l : len(l), pos.sub_splines.values())) 
-      #self.m = float(n) / pos.num_sites
       
       # Mahalanobis distance of remaining estimates. 
-      distances = []
       try:
         inv_C = np.linalg.inv(self.C)
       except np.linalg.linalg.LinAlgError: # Singular 
         self.status = "singular"
       else:
         p_bar = np.mean(B)
-        x_bar = np.array([p_bar.imag, p_bar.real])
-        for x in map(lambda p: np.array([p.imag, p.real]), iter(B)): 
-          y = x - x_bar
-          w = np.dot(np.transpose(y), np.dot(inv_C, y)) 
-          distances.append(w)
+        y = np.vstack((B.imag - p_bar.imag, B.real - p_bar.real))
+        distances = np.sum(y * np.dot(inv_C, y), 0)
        
         # Store just a few distances. 
-        sorted_distances = np.array(sorted(distances))
+        sorted_distances = np.sort(distances)
         self.W = {}
         for level in BOOT_CONF_LEVELS:
           self.W[level] = sorted_distances[int(len(sorted_distances) * level)]
@@ -584,7 +647,7 @@ class BootstrapCovariance3 (BootstrapCovariance):
     else: # not enough samples
       self.status = 'undefined'
 
-def bootstrap_resample(pos, sites, max_resamples, objective_function):
+def bootstrap_resample(pos, sites, max_resamples):
   ''' Generate positionn estimates by sub sampling signal data. 
 
     Construct an objective function from a subset of the pulses (one pulse per site)
@@ -593,130 +656,319 @@ def bootstrap_resample(pos, sites, max_resamples, objective_function):
   '''
   resamples = max(1, max_resamples / (pos.num_sites * (pos.num_sites - 1) / 2))
   P = []
-  for site_ids in itertools.combinations(pos.splines.keys(), 2):
-    P += bootstrap_resample_sites(pos, sites, resamples, objective_function, site_ids)
-  random.shuffle(P)
+  for site_ids in itertools.combinations(sorted(pos.all_spectra.keys()), 2):
+    P += bootstrap_resample_sites(pos, sites, resamples, site_ids)
+  np.random.shuffle(P)
   return P
 
-def bootstrap_resample_sites(pos, sites, resamples, objective_function, site_ids):
-  ''' Resample from a specific set of sites. ''' 
-  N = reduce(int.__mul__, [1] + map(lambda S : len(S), pos.sub_splines.values()))
+def bootstrap_resample_sites(pos, sites, resamples, site_ids):
+  ''' Resample from a specific set of sites. 
+  
+    Each resample is one pulse drawn at random from each site in `site_ids`. 
+  ''' 
+  N = reduce(int.__mul__, [1] + map(lambda S : len(S), pos.all_spectra.values()))
   if N < 2 or pos.p is None: # Number of pulse combinations
     return []
 
-#  a = 1 if objective_function == np.argmin else -1
-#  x0 = np.array([pos.p.imag, pos.p.real])
-  P = []
-  for i in range(resamples):
-    splines = {}
-    for id in site_ids:
-      j = random.randint(0, len(pos.sub_splines[id])-1)
-      splines[id] = pos.sub_splines[id][j]
-#    f = lambda(x) : a * compute_likelihood(sites, splines, np.complex(x[1], x[0]))    
-#    res = scipy.optimize.minimize(f, x0)
-#    p = np.complex(res.x[1], res.x[0])
-    (p, _) = compute_position(sites, splines, pos.p, objective_function,
-              s=POS_EST_S, m=POS_EST_M-1, n=POS_EST_N, delta=POS_EST_DELTA) 
-    P.append(p)
-  return P
+  counts = np.zeros((resamples, sum(map(len, pos.all_spectra.values()))), dtype=np.float64)
+  offset = 0
+  for site_id in sorted(pos.all_spectra.keys()): 
+    n = len(pos.all_spectra[site_id])
+    if site_id in site_ids: 
+      counts[np.arange(resamples), offset + np.random.randint(0, n, resamples)] = 1
+    offset += n
+  return list(resampled_positions(pos, sites, counts))
 
-def bootstrap_case_resample(pos, sites, max_resamples, objective_function):
+def bootstrap_case_resample(pos, sites, max_resamples, counts=None):
   ''' Bootstrap case resampling:
-        https://en.wikipedia.org/wiki/Bootstrapping_(statistics)#Case_resampling '''
-
-
-  #N = reduce(int.__mul__, [1] + map(lambda S : len(S), pos.all_splines.values()))
-  if pos.p is None or pos.num_sites < 2: # Number of pulse combinations
+        https://en.wikipedia.org/wiki/Bootstrapping_(statistics)#Case_resampling 
+  
+    Returns a list of position estimates, one for each resample. `counts` 
+    are the resamples, as drawn by `bootstrap_case_counts()`. 
+  '''
+  if counts is None: 
+    counts = bootstrap_case_counts(pos, max_resamples)
+  if counts is None: 
     return []
+  return list(resampled_positions(pos, sites, counts))
+
+def bootstrap_case_counts(pos, max_resamples):
+  ''' Draw resamples of the pulses of each site. 
+
+    The pulses of a site are resampled with replacement such that the 
+    resample has the same size as the original. If there are fewer than 
+    `max_resamples` distinct combinations of resamples, all of them are 
+    enumerated; otherwise `max_resamples` distinct combinations are drawn 
+    at random. Each is drawn with its probability as a resample, among the 
+    combinations not yet drawn. If there are fewer than `BOOT_ENUMERATE_RATIO` 
+    times `max_resamples` combinations, they are drawn from the enumeration; 
+    otherwise resamples are drawn in bulk and duplicates are replaced by 
+    drawing again. 
+
+    Returns a matrix of the number of times each pulse is drawn, with a row 
+    for each combination of resamples. The columns are the pulses of the 
+    sites in order of siteID, as in `position.Position.all_spectra`. If 
+    there aren't at least two sites, returns `None`. 
+  '''
+  if pos.p is None or pos.num_sites < 2: # Number of pulse combinations
+    return None
 
-  bootstrap_resampled_positions = []
-  site_list = pos.all_splines.keys()  
-  number_of_ests_dict = {}
-
-  #number of exhaustive combinations
-  N=1
-  for siteid in site_list:
-    number_of_ests_dict[siteid] = len(pos.all_splines[siteid])
-    N *= np.math.factorial(2*number_of_ests_dict[siteid]-1)/np.math.factorial(number_of_ests_dict[siteid])/np.math.factorial(number_of_ests_dict[siteid]-1)
-
-
-
-  if (N < max_resamples): #exhaustive search
-    #combinator generator
-    combinator_iter_list = []
-    for siteid in site_list:
-      combinator_iter_list.append(
-          itertools.combinations_with_replacement(
-            [ (siteid, j) for j in range(number_of_ests_dict[siteid]) ], number_of_ests_dict[siteid]
-              )
-                )
-    combinator_generator = itertools.product(*combinator_iter_list)
-
-    for site_spline_tuple_list in combinator_generator:
-      spline_dict = {}
-      for siteid in site_list:
-        spline_dict[siteid] = []
-      for site_spline_tuples in site_spline_tuple_list:
-        for site, est_index in site_spline_tuples:
-          spline_dict[site].append(pos.all_splines[site][est_index])
-      (p, _) = compute_position(sites, spline_dict, pos.p, objective_function,
-              s=POS_EST_S, m=POS_EST_M-1, n=POS_EST_N, delta=POS_EST_DELTA)#FIXME
-      bootstrap_resampled_positions.append(p)
+  site_list = sorted(pos.all_spectra.keys())
+  number_of_ests = [ len(pos.all_spectra[siteid]) for siteid in site_list ]
 
-    
+  # Number of exhaustive combinations, (2n-1)! / (n! (n-1)!) for each site. 
+  n = np.array(number_of_ests, dtype=np.float64)
+  log_N = np.sum(gammaln(2*n) - gammaln(n+1) - gammaln(n))
+
+  if log_N < np.log(max_resamples): #exhaustive search
+    return _enumerate_counts(number_of_ests)
+  
+  elif log_N < np.log(BOOT_ENUMERATE_RATIO * max_resamples): 
+    counts = _enumerate_counts(number_of_ests)
+    weight = np.exp(-np.sum(gammaln(counts + 1), 1))
+    return counts[np.random.choice(len(counts), max_resamples, replace=False, 
+                                   p=weight / np.sum(weight))]
+  
   else: #monte carlo
-    #combo_pool = tuple(combinator_generator)
-    number_of_combos = N#len(combo_pool)
+    counts = _draw_counts(number_of_ests, max_resamples)
+    counts = counts[_unique_rows(counts)]
+    while len(counts) < max_resamples: 
+      counts = np.vstack((counts, _draw_counts(number_of_ests, 2 * (max_resamples - len(counts)))))
+      counts = counts[_unique_rows(counts)]
+    return counts[:max_resamples]
+
+def _enumerate_counts(number_of_ests): 
+  ''' All combinations of resamples, as rows of pulse counts. The rows are 
+    in the order of `itertools.product()` of the resamples of each site. ''' 
+  site_counts = []
+  for n in number_of_ests: 
+    site_counts.append(np.array([ np.bincount(choices, minlength=n) 
+        for choices in itertools.combinations_with_replacement(range(n), n) ], dtype=np.float64))
+  index = np.indices([ len(c) for c in site_counts ]).reshape(len(site_counts), -1)
+  return np.hstack([ c[i] for (c, i) in zip(site_counts, index) ])
+
+def _draw_counts(number_of_ests, size): 
+  ''' Draw `size` resamples at random, as rows of pulse counts. ''' 
+  counts = np.empty((size, sum(number_of_ests)), dtype=np.float64)
+  offset = 0
+  for n in number_of_ests: 
+    counts[:,offset:offset+n] = np.random.multinomial(n, [1.0 / n] * n, size)
+    offset += n
+  return counts
+
+def _unique_rows(counts): 
+  ''' Indices of the first occurrence of each distinct row of `counts`, 
+    in order. Rows are compared as strings of bytes. ''' 
+  rows = np.ascontiguousarray(counts.astype(np.int32))
+  rows = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+  (_, index) = np.unique(rows, return_index=True)
+  return np.sort(index)
+
+def resampled_positions(pos, sites, counts, solver=None):
+  ''' Estimate the position of each resample in `counts`. 
+
+    The likelihood surface of a resample is the sum of the bearing likelihoods 
+    of the pulses it draws, weighted by the number of times each is drawn 
+    (see `class position_covariance.ResampleSurface`). Each resample is 
+    estimated by `solver` in the square of half-width `BOOT_LOCAL_SPAN` 
+    around `pos.p`. If its estimate is on the edge of the square, it is 
+    estimated again by the wider search described for `BOOT_SPAN`. 
+
+    Inputs: 
+
+      pos -- instance of `class position.Position`, with `all_spectra`. 
+
+      sites -- mapping of siteIDs to receiver locations. 
+      
+      counts -- resamples, as given by `bootstrap_case_counts()`. 
+
+      solver -- 'grid', 'newton', or a function `solver(surface, counts, 
+                centers, span)`, where `surface` is an instance of `class 
+                position_covariance.ResampleSurface`, that returns the 
+                estimate of each resample in the square of half-width `span` 
+                around `centers` and whether it is on the edge of the square. 
+                Defaults to `BOOT_SOLVER`. 
     
-    uniqueness_dict = {}
-    for j in range(max_resamples):
-      spline_dict = {}
-      for site in site_list:
-        spline_dict[site] = []
-
-      unique = False
-      while not unique:
-        #pick random sample
-        current_combo = []
-        for site in site_list:
-          current_est_choices = []
-          for k in range(number_of_ests_dict[site]):
-            current_est_choices.append(random.randrange(number_of_ests_dict[site]))
-          current_est_choices.sort()
-          current_combo.append(tuple(current_est_choices))
-        #test if chosen before
-        if not tuple(current_combo) in uniqueness_dict:
-          uniqueness_dict[tuple(current_combo)]=1
-          unique = True
-          
+    Returns an array of UTM positions represented as complex numbers. 
+  '''
+  if solver is None: 
+    solver = BOOT_SOLVER
+  if solver == 'grid': 
+    solver = solve_grid
+  elif solver == 'newton': 
+    solver = solve_newton
+
+  surface = ResampleSurface(pos, sites)
+  centers = np.empty(counts.shape[0], dtype=np.complex128)
+  centers[:] = pos.p
+  (p, edge) = solver(surface, counts, centers, BOOT_LOCAL_SPAN)
+  
+  # Fall back to the wider search. 
+  todo = np.flatnonzero(edge)
+  for shift in range(BOOT_MAX_SHIFTS + 1): 
+    if len(todo) == 0: 
+      break
+    (p[todo], edge) = _local_grid_search(surface, counts[todo], centers[todo], BOOT_SPAN, BOOT_LEVELS)
+    todo = todo[edge]
+    centers[todo] = p[todo]
+  return p
 
-      #build splines
-      for k, site in enumerate(site_list):
-        est_choices = current_combo[k]
-        for m in est_choices:
-          spline_dict[site].append(pos.all_splines[site][m])
-      #for site_spline_tuples in current_combo:#combo_pool[index]:
-        #for site, est_index in site_spline_tuples:
-        #  spline_dict[site].append(pos.all_splines[site][est_index])
-      #compute position
-      (p, _) = compute_position(sites, spline_dict, pos.p, objective_function,
-              s=POS_EST_S, m=POS_EST_M-1, n=POS_EST_N, delta=POS_EST_DELTA)
-      bootstrap_resampled_positions.append(p)
+def solve_grid(surface, counts, centers, span):
+  ''' Coarse-to-fine grid search through `BOOT_LEVELS`. ''' 
+  return _local_grid_search(surface, counts, centers, span, BOOT_LEVELS)
+
+def solve_newton(surface, counts, centers, span): 
+  ''' Newton's method on the resampled likelihood surfaces. 
+  
+    Start from the best point of a grid with step `BOOT_LEVELS[0]`. A step 
+    is at most the trust radius, initially `BOOT_LEVELS[0]`, and is taken 
+    only if it doesn't decrease the likelihood; otherwise the trust radius 
+    is shrunk. Where the Hessian isn't negative definite, the step is along 
+    the gradient. Iterate until the steps are shorter than `BOOT_NEWTON_TOL` 
+    or for `BOOT_NEWTON_STEPS` steps. 
+  ''' 
+  (p, edge) = _local_grid_search(surface, counts, centers, span, BOOT_LEVELS[:1])
+  (f, g, H) = surface.derivatives(counts, p)
+  trust = np.empty(len(p), dtype=np.float64)
+  trust[:] = BOOT_LEVELS[0]
+  active = np.flatnonzero(~edge)
+  for step in range(BOOT_NEWTON_STEPS): 
+    if len(active) == 0: 
+      break
+    (g_e, g_n) = (g[0][active], g[1][active])
+    (h_ee, h_en, h_nn) = (H[0][active], H[1][active], H[2][active])
+    det = (h_ee * h_nn) - (h_en ** 2)
+    newton = (h_ee < 0) & (det > 0)
+    det[~newton] = 1
+    d = np.where(newton, 
+          np.complex(0,1) * (h_en * g_n - h_nn * g_e) / det + (h_en * g_e - h_ee * g_n) / det, 
+          np.complex(0,1) * g_e + g_n)
+    length = np.maximum(np.abs(d), 1e-12)
+    d *= np.minimum(np.where(newton, 1, np.inf), trust[active] / length)
+    
+    q = p[active] + d
+    (f_q, g_q, H_q) = surface.derivatives(counts[active], q)
+    better = f_q >= f[active]
+    i = active[better]
+    (p[i], f[i]) = (q[better], f_q[better])
+    for (a, b) in zip(g + H, g_q + H_q): 
+      a[i] = b[better]
+    trust[active[~better]] /= 4
+    done = np.abs(d) < BOOT_NEWTON_TOL
+    active = active[~done]
+
+  d = p - centers
+  edge |= (np.abs(d.real) >= span) | (np.abs(d.imag) >= span)
+  return (p, edge)
+
+def _local_grid_search(surface, counts, centers, span, levels):
+  ''' Coarse-to-fine grid search of the resampled likelihood surfaces. 
+  
+    Resample `i` is searched over the square of half-width `span` around 
+    `centers[i]` with step `levels[0]`, then refined around the best point 
+    through the remaining levels as in `position.compute_position_pyramid()`. 
+    Returns the best point of each resample and whether it was on the edge 
+    of the square. 
+  '''
+  p = centers
+  for (k, (width, step)) in enumerate(zip([span] + levels[:-1], levels)):
+    n = 2 * int(round(float(width) / step)) + 1
+    offsets = np.linspace(-width, width, n)
+    offsets = (offsets[np.newaxis,:] + (np.complex(0,1) * offsets[:,np.newaxis])).ravel()
+    
+    # Resamples at the same point share the grid around it. The likelihoods 
+    # of the pulses are computed for a block of points at a time. 
+    (seeds, inverse) = np.unique(p, return_inverse=True)
+    best = np.empty(len(p), dtype=np.int64)
+    block = max(1, BOOT_BLOCK_SIZE / (counts.shape[1] * len(offsets)))
+    for i in range(0, len(seeds), block): 
+      L = surface.likelihoods(seeds[i:i+block,np.newaxis] + offsets[np.newaxis,:])
+      for j in range(L.shape[1]): 
+        rows = np.flatnonzero(inverse == i + j)
+        best[rows] = np.argmax(np.dot(counts[rows], L[:,j,:]), 1)
+    
+    if k == 0: 
+      (row, col) = (best / n, best % n)
+      edge = (row == 0) | (row == n-1) | (col == 0) | (col == n-1)
+    p = p + offsets[best]
+  return (p, edge)
 
 
+class ResampleSurface: 
+  
+  def __init__(self, pos, sites): 
+    ''' Likelihood surfaces of resamples of the pulses of a position. 
 
+      A resample is given by the number of times each pulse is drawn, in 
+      the order of the columns of `bootstrap_case_counts()`. Its likelihood 
+      is the sum of the bearing likelihoods of the pulses, each interpolated 
+      by `position.compute_bearing_spline()`, weighted by these counts. If 
+      `position.NORMALIZE_SPECTRUM` is set, the weights of a site are also 
+      divided by its number of pulses, as in `position.aggregate_window()`, 
+      so that the surface of the original sample is that of `pos`. 
 
+      Inputs: 
 
+        pos -- instance of `class position.Position`, with `all_spectra`. 
 
-    #indices = sorted(random.sample(xrange(number_of_combos), max_resamples))
-    #count = 0
-    #current_combo = combinator_generator.next()
-    #for index in indices:
-    #  while count < index:
-    #    count +=1
-    #    current_combo = combinator_generator.next()
+        sites -- mapping of siteIDs to receiver locations. 
+    '''
+    self.sites = sites
+    self.site_ids = sorted(pos.all_spectra.keys())
+    self.splines = [ map(position.compute_bearing_spline, pos.all_spectra[site_id]) 
+                                                     for site_id in self.site_ids ]
+    if position.NORMALIZE_SPECTRUM: 
+      self.weights = [ 1.0 / len(splines) for splines in self.splines ]
+    else: 
+      self.weights = [ 1.0 for splines in self.splines ]
+  
+  def likelihoods(self, positions): 
+    ''' Likelihood of each pulse at each of `positions`. 
+    
+      Returns an array with a row for each pulse, and the remaining 
+      dimensions those of `positions`. 
+    '''
+    L = []
+    for (site_id, splines, w) in zip(self.site_ids, self.splines, self.weights):
+      bearing = np.angle(positions - self.sites[site_id]).ravel() * 180 / np.pi
+      L += [ w * spline(bearing) for spline in splines ]
+    return np.array(L).reshape((len(L),) + positions.shape)
+
+  def derivatives(self, counts, p): 
+    ''' Likelihood, gradient, and Hessian of the surface of each resample. 
+    
+      Resample `i` (row `i` of `counts`) is evaluated at `p[i]`. Returns 
+      `(f, (f_e, f_n), (f_ee, f_en, f_nn))`, arrays with an element per 
+      resample, where `e` is easting and `n` is northing. 
+    '''
+    f = np.zeros(len(p), dtype=np.float64)
+    g = (np.zeros(len(p)), np.zeros(len(p)))
+    H = (np.zeros(len(p)), np.zeros(len(p)), np.zeros(len(p)))
+    k = 0
+    for (site_id, splines, w) in zip(self.site_ids, self.splines, self.weights):
+      d = p - self.sites[site_id]
+      (de, dn) = (d.imag, d.real)
+      r2 = de ** 2 + dn ** 2
+      bearing = np.angle(d) * 180 / np.pi
+      c = w * counts[:,k:k+len(splines)]
+      k += len(splines)
       
-  return bootstrap_resampled_positions
+      # Derivatives of the site's likelihood by bearing ...
+      (F0, F1, F2) = [ np.sum(c * np.array([ spline(bearing, nu) for spline in splines ]).T, 1) 
+                                                                    for nu in range(3) ]
+      # ... and of the bearing (in degrees) by easting and northing. 
+      deg = 180 / np.pi
+      (t_e, t_n) = (deg * dn / r2, -deg * de / r2)
+      (t_ee, t_en, t_nn) = (-2 * deg * de * dn / r2 ** 2, 
+                            deg * (de ** 2 - dn ** 2) / r2 ** 2, 
+                            2 * deg * de * dn / r2 ** 2)
+      f += F0
+      g[0][:] += F1 * t_e
+      g[1][:] += F1 * t_n
+      H[0][:] += F2 * t_e ** 2 + F1 * t_ee
+      H[1][:] += F2 * t_e * t_n + F1 * t_en
+      H[2][:] += F2 * t_n ** 2 + F1 * t_nn
+    return (f, g, H)
 
 def compute_conf(C, Qt, scale=1):
   ''' Compute confidence region from covariance matrix.
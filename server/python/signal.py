@@ -26,9 +26,11 @@
 
 from . import util
 
-import sys
+import MySQLdb.cursors
+import sys, os, shutil, tempfile
 import numpy as np
 import functools
+import multiprocessing
 from scipy.interpolate import InterpolatedUnivariateSpline as spline1d
 
 
@@ -137,6 +139,35 @@ NUM_CHANNELS = 4
 TWO_PI = 2 * np.pi
 PI_N = np.pi ** NUM_CHANNELS
 
+# Columns of `qraat.est` used for the signal model. 
+EST_COLUMNS = '''ID, siteID, timestamp, edsp, 
+                 ed1r,  ed1i,  ed2r,  ed2i,  
+                 ed3r,  ed3i,  ed4r,  ed4i, tnp,
+                 nc11r, nc11i, nc12r, nc12i, nc13r, nc13i, nc14r, nc14i, 
+                 nc21r, nc21i, nc22r, nc22i, nc23r, nc23i, nc24r, nc24i, 
+                 nc31r, nc31i, nc32r, nc32i, nc33r, nc33i, nc34r, nc34i, 
+                 nc41r, nc41i, nc42r, nc42i, nc43r, nc43i, nc44r, nc44i'''
+
+EST_FIELDS = [ col.strip() for col in EST_COLUMNS.split(',') ]
+
+def _decode_est(raw_data): 
+  ''' Decode rows of `EST_COLUMNS` as floats into a mapping of arrays. 
+  
+    Real and imaginary parts are adjacent columns, so the blocks of 
+    columns can be viewed as complex numbers. The signal vector is 
+    stored conjugated.
+  '''
+  est = {}
+  est['est_ids'] = np.array(raw_data[:,0], dtype=int)
+  est['site_ids'] = np.array(raw_data[:,1], dtype=int)
+  est['t'] = raw_data[:,2]
+  est['edsp'] = raw_data[:,3]
+  est['tnp'] = raw_data[:,12]
+  est['signal_vector'] = np.conj(np.ascontiguousarray(raw_data[:,4:12]).view(np.complex))
+  est['noise_cov'] = np.ascontiguousarray(raw_data[:,13:45]).view(np.complex).reshape(
+                                          (raw_data.shape[0], NUM_CHANNELS, NUM_CHANNELS))
+  return est
+
 class Signal:
 
   def __init__(self, *args, **kwargs):
@@ -158,7 +189,7 @@ class Signal:
       self.read_db(*args, **kwargs)
 
   def read_db(self, db_con, dep_id, t_start, t_end,
-                score_threshold=None, include=[], exclude=[]):
+                score_threshold=None, include=[], exclude=[], stream=False):
     ''' Read signals from database. 
 
       Inputs: 
@@ -172,78 +203,192 @@ class Signal:
 
         score_threshold -- Signals are given scores based on how likely we 
                            think they are real signals and not just noise. 
+
+        stream -- If True, count the rows first and then stream them from 
+                  the server into a preallocated array, rather than 
+                  fetching them all as a list of tuples. 
     '''
     cur = db_con.cursor()
     if score_threshold is not None: 
-      ct = cur.execute('''SELECT ID, siteID, timestamp, edsp, 
-                                 ed1r,  ed1i,  ed2r,  ed2i,  
-                                 ed3r,  ed3i,  ed4r,  ed4i, tnp,
-                                 nc11r, nc11i, nc12r, nc12i, nc13r, nc13i, nc14r, nc14i, 
-                                 nc21r, nc21i, nc22r, nc22i, nc23r, nc23i, nc24r, nc24i, 
-                                 nc31r, nc31i, nc32r, nc32i, nc33r, nc33i, nc34r, nc34i, 
-                                 nc41r, nc41i, nc42r, nc42i, nc43r, nc43i, nc44r, nc44i 
-                            FROM est
-                            JOIN estscore ON est.ID = estscore.estID
-                           WHERE deploymentID= %s
-                             AND timestamp >= %s 
-                             AND timestamp <= %s
-                             AND (score / theoretical_score) >= %s
-                           ORDER BY timestamp''', 
-                (dep_id, t_start, t_end, score_threshold))
+      query = '''FROM est
+                 JOIN estscore ON est.ID = estscore.estID
+                WHERE deploymentID= %s
+                  AND timestamp >= %s 
+                  AND timestamp <= %s
+                  AND (score / theoretical_score) >= %s'''
+      args = (dep_id, t_start, t_end, score_threshold)
+    else:
+      query = '''FROM est
+                WHERE deploymentID= %s
+                  AND timestamp >= %s 
+                  AND timestamp <= %s'''
+      args = (dep_id, t_start, t_end)
+    if stream:
+      cur.execute('SELECT COUNT(*) %s' % query, args)
+      (ct,) = cur.fetchone()
+      cur = db_con.cursor(MySQLdb.cursors.SSCursor)
+      cur.execute('SELECT %s %s ORDER BY timestamp' % (EST_COLUMNS, query), args)
+      raw_data = util.fetch_array(cur, ct, 45)
+      ct = raw_data.shape[0]
     else:
-      ct = cur.execute('''SELECT ID, siteID, timestamp, edsp, 
-                                 ed1r,  ed1i,  ed2r,  ed2i,  
-                                 ed3r,  ed3i,  ed4r,  ed4i, tnp,
-                                 nc11r, nc11i, nc12r, nc12i, nc13r, nc13i, nc14r, nc14i, 
-                                 nc21r, nc21i, nc22r, nc22i, nc23r, nc23i, nc24r, nc24i, 
-                                 nc31r, nc31i, nc32r, nc32i, nc33r, nc33i, nc34r, nc34i, 
-                                 nc41r, nc41i, nc42r, nc42i, nc43r, nc43i, nc44r, nc44i 
-                            FROM est
-                           WHERE deploymentID= %s
-                             AND timestamp >= %s 
-                             AND timestamp <= %s
-                           ORDER BY timestamp''', 
-                (dep_id, t_start, t_end))
+      ct = cur.execute('SELECT %s %s ORDER BY timestamp' % (EST_COLUMNS, query), args)
+      if ct > 0:
+        raw_data = np.array(cur.fetchall(), dtype=float)
  
     if ct > 0:
-      raw_data = np.array(cur.fetchall(), dtype=float)
-      est_ids = np.array(raw_data[:,0], dtype=int)
-      self.max_est_id = np.max(est_ids)
-      site_ids = np.array(raw_data[:,1], dtype=int)
-      timestamps = raw_data[:,2]
-      edsp = raw_data[:,3]
-      signal_vector = np.zeros((raw_data.shape[0], NUM_CHANNELS),dtype=np.complex)
-      for j in range(NUM_CHANNELS):
-        signal_vector[:,j] = raw_data[:,2*j+4] + np.complex(0,-1)*raw_data[:,2*j+5]
-
-      tnp = raw_data[:,12]
-      noise_cov = np.zeros((raw_data.shape[0],NUM_CHANNELS,NUM_CHANNELS),dtype=np.complex)
-      for t in range(raw_data.shape[0]):      
-        for i in range(NUM_CHANNELS):
-          for j in range(NUM_CHANNELS):
-            k = 13 + (i*NUM_CHANNELS*2) + (2*j)
-            noise_cov[t,i,j] = np.complex(raw_data[t,k], raw_data[t,k+1])
-
-      if include == []:
-        inc = set(site_ids)
-      else: 
-        inc = set(include)
-
-      for site_id in inc.difference(set(exclude)):
-        mask = site_ids == site_id
-        site = _per_site_data(site_id)
-        site.est_ids = est_ids[mask]
-        site.t = timestamps[mask]
-        site.edsp = edsp[mask] # a.k.a. power
-        site.signal_vector = signal_vector[mask]
-        site.tnp = tnp[mask]
-        site.noise_cov = noise_cov[mask]
-        site.count = len(est_ids)
-        self.table[site_id] = site
-
-      self.t_start = np.min(timestamps)
-      self.t_end = np.max(timestamps)
-      self.max_id = np.max(est_ids)
+      self._load(_decode_est(raw_data), include, exclude)
+
+  def read_records(self, records, dep_id=None, t_start=None, t_end=None, 
+                     include=[], exclude=[]):
+    ''' Read signals from est records rather than the database. 
+
+      Inputs: 
+
+        records -- an array of est records, or an iterable of them, e.g. 
+                   the batches yielded by `qraat.est.read_archive()`. Field 
+                   names are those of the est table (case is ignored). 
+
+        dep_id -- if given, only records of this deployment (txid) are 
+                  read. 
+
+        t_start, t_end -- if given, time range of the records read. 
+
+      Est archives don't have scores, so no score threshold is applied. 
+      Archives written before est IDs were archived have an ID of 0 for 
+      every record (see `qraat.est.read_archive()`). Bearings computed from
+      such signals must not be inserted into the database, since their 
+      provenance would point to est 0. 
+    '''
+    if isinstance(records, np.ndarray):
+      records = [records]
+    raw_data = []
+    for batch in records: 
+      names = dict((name.lower(), name) for name in batch.dtype.names)
+      mask = np.ones(len(batch), dtype=bool)
+      if dep_id is not None: 
+        mask &= batch[names['txid']] == dep_id
+      if t_start is not None: 
+        mask &= batch[names['timestamp']] >= t_start
+      if t_end is not None: 
+        mask &= batch[names['timestamp']] <= t_end
+      batch = batch[mask]
+      raw_data.append(np.column_stack([ batch[names[col.lower()]].astype(float) 
+                                          for col in EST_FIELDS ]))
+    
+    if len(raw_data) > 0:
+      raw_data = np.vstack(raw_data)
+      if raw_data.shape[0] > 0: 
+        raw_data = raw_data[np.argsort(raw_data[:,2], kind='mergesort')]
+        self._load(_decode_est(raw_data), include, exclude)
+  
+  def _load(self, est, include=[], exclude=[]):
+    ''' Split decoded est rows (see `_decode_est()`) by site. '''
+    est_ids = est['est_ids']
+    self.max_est_id = np.max(est_ids)
+    site_ids = est['site_ids']
+    timestamps = est['t']
+    edsp = est['edsp']
+    tnp = est['tnp']
+    signal_vector = est['signal_vector']
+    noise_cov = est['noise_cov']
+
+    if include == []:
+      inc = set(site_ids)
+    else: 
+      inc = set(include)
+
+    for site_id in inc.difference(set(exclude)):
+      mask = site_ids == site_id
+      site = _per_site_data(site_id)
+      site.est_ids = est_ids[mask]
+      site.t = timestamps[mask]
+      site.edsp = edsp[mask] # a.k.a. power
+      site.signal_vector = signal_vector[mask]
+      site.tnp = tnp[mask]
+      site.noise_cov = noise_cov[mask]
+      site.count = len(site.est_ids)
+      self.table[site_id] = site
+
+    self.t_start = np.min(timestamps)
+    self.t_end = np.max(timestamps)
+    self.max_id = np.max(est_ids)
+
+  def read_cache(self, cache_dir, db_con, dep_id, t_start, t_end,
+                   score_threshold=None, include=[], exclude=[]):
+    ''' Read signals from the on-disk cache. 
+
+      The cache holds the est data of each deployment in bundles covering a 
+      `CACHE_PERIOD` (a day, in UTC). A bundle has an array per site for each 
+      of `CACHE_FIELDS`, stored as a .npy file. Arrays are memory mapped, so
+      data are only read when used. If the time range is within a bundle 
+      and there's no score threshold, the data are views of the mapped 
+      arrays and nothing is copied. 
+
+      Inputs are as for `signal.Signal.read_db()`, except: 
+
+        cache_dir -- directory of the cache. 
+
+        db_con -- MySQL database connector, or None. If given, each bundle is
+                  validated against the database by the number of pulses, 
+                  the maximum estID and the total scores per site, and 
+                  (re)written if it's missing or stale. If None, the 
+                  database isn't used at all and the bundles must exist. 
+
+      The score threshold is applied to the ratio of score and theoretical 
+      score in floating point. 
+    '''
+    parts = {} # site.ID -> [ (field -> array) ] 
+    for day in range(int(t_start // CACHE_PERIOD), int(t_end // CACHE_PERIOD) + 1):
+      for (site_id, fields) in _read_bundle(cache_dir, db_con, dep_id, day).iteritems():
+        i = np.searchsorted(fields['t'], t_start, side='left')
+        j = np.searchsorted(fields['t'], t_end, side='right')
+        if i < j: 
+          parts.setdefault(site_id, []).append(dict((field, fields[field][i:j]) 
+                                                      for field in CACHE_FIELDS))
+    if len(parts) == 0: 
+      return
+
+    if include == []:
+      inc = set(parts.keys())
+    else: 
+      inc = set(include)
+
+    # Sites without pulses in the range (after thresholding) are left out. 
+    # If no site has any, the signal is empty, as with `read_db()`. 
+    for site_id in inc.difference(set(exclude)):
+      if site_id not in parts: 
+        continue
+      fields = {}
+      for field in CACHE_FIELDS: 
+        if len(parts[site_id]) == 1: 
+          fields[field] = parts[site_id][0][field]
+        else:
+          fields[field] = np.concatenate([ part[field] for part in parts[site_id] ])
+      if score_threshold is not None: 
+        # Like MySQL, a ratio with a zero denominator is NULL. 
+        theoretical_score = fields['theoretical_score'].astype(float)
+        theoretical_score[theoretical_score == 0] = np.nan
+        with np.errstate(invalid='ignore'):
+          mask = (fields['score'] / theoretical_score) >= score_threshold
+        if not mask.any(): 
+          continue
+        for field in CACHE_FIELDS: 
+          fields[field] = fields[field][mask]
+      
+      site = _per_site_data(site_id)
+      site.est_ids = fields['est_ids']
+      site.t = fields['t']
+      site.edsp = fields['edsp'] # a.k.a. power
+      site.signal_vector = fields['signal_vector']
+      site.tnp = fields['tnp']
+      site.noise_cov = fields['noise_cov']
+      site.count = len(site.est_ids)
+      self.table[site_id] = site
+      
+      self.t_start = min(self.t_start, site.t[0])
+      self.t_end = max(self.t_end, site.t[-1])
+      self.max_id = max(self.max_id, np.max(site.est_ids))
+    self.max_est_id = self.max_id
 
   @classmethod
   def read(cls, site_ids, prefix='sig'):
@@ -329,6 +474,53 @@ def _mle(V, G, edsp, noise_cov, ct, j):
   return p
 
 
+# Number of pulses for which the batched MLE computes the bearing spectrum at
+# once. Peak memory is a few arrays of `MLE_CHUNK_SIZE` x 360 complex numbers.
+MLE_CHUNK_SIZE = 2000
+
+def _mle_batch(V, G, edsp, noise_cov):
+  ''' Batched MLE bearing spectrum computation.
+
+    Same result as ``_mle()`` over all whole-degree bearings, but computed for
+    a block of pulses at once. The covariance of the model for pulse `i` and
+    bearing `j` is a rank-1 update of the noise covariance,
+
+      R = edsp[i] * G_j G_j^H + N_i.
+
+    By the matrix determinant lemma and the Sherman-Morrison formula,
+
+      det(R) = det(N_i) (1 + edsp[i] G_j^H N_i^-1 G_j),
+
+      V^H R^-1 V = V^H N_i^-1 V - edsp[i] (V^H N_i^-1 G_j)(G_j^H N_i^-1 V)
+                                         / (1 + edsp[i] G_j^H N_i^-1 G_j),
+
+    so only the noise covariance of each pulse is inverted.
+
+    Inputs:
+
+      V -- signal vectors, (ct, NUM_CHANNELS) array.
+
+      G -- steering vectors, (360, NUM_CHANNELS) array.
+
+      edsp -- signal power, array of length ct.
+
+      noise_cov -- noise covariance, (ct, NUM_CHANNELS, NUM_CHANNELS) array.
+
+    Returns a (ct, 360) array.
+  '''
+  V = np.asarray(V); G = np.asarray(G)
+  N_inv = np.linalg.inv(noise_cov)
+  N_det = np.abs(np.linalg.det(noise_cov))
+  VN = np.einsum('ik,ikl->il', np.conj(V), N_inv)      # V^H N^-1
+  NV = np.einsum('ikl,il->ik', N_inv, V)               # N^-1 V
+  c = np.einsum('ik,ik->i', VN, V)                     # V^H N^-1 V
+  q = np.einsum('jk,ikl,jl->ij', np.conj(G), N_inv, G) # G^H N^-1 G
+  e = np.asarray(edsp, dtype=np.float64)[:,np.newaxis]
+  d = 1 + (e * q)
+  a = c[:,np.newaxis] - (e * np.dot(VN, G.T) * np.dot(NV, np.conj(G).T) / d)
+  return -np.log(N_det[:,np.newaxis] * np.abs(d) * PI_N) - np.abs(a)
+
+
 class _per_site_data: 
   
   suffix = 'csv'
@@ -362,6 +554,18 @@ class _per_site_data:
       yield (self.est_ids[i], self.t[i], self.edsp[i],
              self.signal_vector[i], self.noise_cov[i])
 
+  def slice(self, i, j):
+    ''' Return the pulses with indices `i` through `j-1` as a new object. '''
+    site = _per_site_data(self.site_id)
+    site.est_ids = self.est_ids[i:j]
+    site.t = self.t[i:j]
+    site.tnp = self.tnp[i:j]
+    site.edsp = self.edsp[i:j]
+    site.signal_vector = self.signal_vector[i:j]
+    site.noise_cov = self.noise_cov[i:j]
+    site.count = len(site.est_ids)
+    return site
+
   def read(self, prefix):
     fn = '%s%d.%s' % (prefix, self.site_id, self.suffix)
     fd = open(fn, 'r')
@@ -410,20 +614,21 @@ class _per_site_data:
       
       Compute ln(f(V | theta)). The Hermation operator, as in $V^H$ or 
       $G_i(\theta)^H in the equations, is written here as 
-      `np.conj(np.transpose())`. 
+      `np.conj(np.transpose())`. The spectrum is computed in blocks of
+      `MLE_CHUNK_SIZE` pulses by `_mle_batch()`.
+
+      Input:
 
-      Input: 
-        
         sv -- instance of `class SteeringVectors`.
 
-      Returns the bearing spectrum. 
-    ''' 
-    f = functools.partial(_mle, np.matrix(self.signal_vector), 
-                                sv.steering_vectors[self.site_id],
-                                self.edsp, self.noise_cov, self.count)
+      Returns the bearing spectrum.
+    '''
+    G = sv.steering_vectors[self.site_id]
     p = np.zeros((self.count, 360), dtype=np.float64)
-    for j in range(360):
-      p[:,j] = f(j)
+    for i in range(0, self.count, MLE_CHUNK_SIZE):
+      j = i + MLE_CHUNK_SIZE
+      p[i:j] = _mle_batch(self.signal_vector[i:j], G,
+                          self.edsp[i:j], self.noise_cov[i:j])
     return p
 
   def bartlet(self, sv): 
@@ -436,6 +641,229 @@ class _per_site_data:
 
 
 
+### Signal cache. #############################################################
+
+# Length of the period covered by a cache bundle. 
+CACHE_PERIOD = 60 * 60 * 24 # seconds
+
+# Arrays stored in a cache bundle for each site. The scores are zero if the
+# pulse hasn't been scored. 
+CACHE_FIELDS = ['est_ids', 't', 'edsp', 'tnp', 'signal_vector', 'noise_cov', 
+                'score', 'theoretical_score']
+
+# Bundles validated against the database by this process. 
+_validated_bundles = set()
+
+def _bundle_path(cache_dir, dep_id, day):
+  return os.path.join(cache_dir, 'dep%d' % dep_id, 'day%d' % day)
+
+def _bundle_summary(db_con, dep_id, day):
+  ''' Summarize the est data of a bundle in the database.
+
+    Returns an array with a row (siteID, count, max estID, total score, 
+    total theoretical score) per site, sorted by siteID. A bundle is valid
+    if the same summary was computed from its data. 
+  ''' 
+  cur = db_con.cursor()
+  cur.execute('''SELECT siteID, COUNT(*), MAX(est.ID), 
+                        SUM(IFNULL(score, 0)), SUM(IFNULL(theoretical_score, 0))
+                   FROM est
+              LEFT JOIN estscore ON est.ID = estscore.estID
+                  WHERE deploymentID = %s
+                    AND timestamp >= %s 
+                    AND timestamp < %s
+                  GROUP BY siteID
+                  ORDER BY siteID''', 
+          (dep_id, day * CACHE_PERIOD, (day + 1) * CACHE_PERIOD))
+  return np.array(cur.fetchall(), dtype=np.int64).reshape((-1, 5))
+
+def _write_bundle(cache_dir, db_con, dep_id, day):
+  ''' Fetch the est data of a bundle and write it to the cache. 
+
+    The bundle is a symbolic link to a directory holding its arrays. A new
+    version is written to a new directory, the link is atomically replaced
+    by one to it, and then the old version is deleted, so readers never 
+    see a partial or missing bundle. (Bundles written by older versions of 
+    this module are directories; such a bundle is renamed aside first.) 
+    Returns the directory of the new version and the summary of the bundle
+    (see `_bundle_summary()`). 
+  '''
+  cur = db_con.cursor()
+  ct = cur.execute('''SELECT %s, IFNULL(score, 0), IFNULL(theoretical_score, 0)
+                        FROM est
+                   LEFT JOIN estscore ON est.ID = estscore.estID
+                       WHERE deploymentID = %%s
+                         AND timestamp >= %%s 
+                         AND timestamp < %%s
+                       ORDER BY timestamp''' % EST_COLUMNS, 
+          (dep_id, day * CACHE_PERIOD, (day + 1) * CACHE_PERIOD))
+  raw_data = np.array(cur.fetchall(), dtype=float).reshape((ct, 47))
+  est = _decode_est(raw_data)
+  est['score'] = np.array(raw_data[:,45], dtype=np.int64)
+  est['theoretical_score'] = np.array(raw_data[:,46], dtype=np.int64)
+  
+  path = _bundle_path(cache_dir, dep_id, day)
+  if not os.path.exists(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path))
+  summary = []
+  for site_id in np.unique(est['site_ids']):
+    mask = est['site_ids'] == site_id
+    for field in CACHE_FIELDS: 
+      np.save(os.path.join(tmp, '%d.%s.npy' % (site_id, field)), est[field][mask])
+    summary.append((site_id, np.sum(mask), np.max(est['est_ids'][mask]), 
+                    np.sum(est['score'][mask]), np.sum(est['theoretical_score'][mask])))
+  summary = np.array(summary, dtype=np.int64).reshape((-1, 5))
+  np.save(os.path.join(tmp, 'summary.npy'), summary)
+  
+  old = None
+  if os.path.islink(path): 
+    old = os.path.realpath(path)
+  elif os.path.exists(path): 
+    old = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path))
+    os.rename(path, old)
+  link = tmp + '.link'
+  os.symlink(os.path.basename(tmp), link)
+  os.rename(link, path)
+  if old is not None: 
+    shutil.rmtree(old)
+  return (tmp, summary)
+
+def _load_bundle(path):
+  ''' Memory map the arrays of a version of a bundle. Returns its summary 
+    and a mapping from siteIDs to the arrays. ''' 
+  summary = np.load(os.path.join(path, 'summary.npy'))
+  bundle = {}
+  for site_id in summary[:,0]:
+    bundle[int(site_id)] = dict((field, np.load(os.path.join(path, '%d.%s.npy' % (site_id, field)), 
+                                                mmap_mode='r')) for field in CACHE_FIELDS)
+  return (summary, bundle)
+
+def _read_bundle(cache_dir, db_con, dep_id, day):
+  ''' Return a mapping from siteIDs to the arrays of a bundle. 
+    
+    The arrays are memory mapped. If `db_con` is given, the bundle is 
+    validated against the database once per process and (re)written if 
+    it's missing or stale. Otherwise a missing bundle is an error. The
+    link to the bundle is resolved once, so that its summary and arrays
+    come from the same version (see `_write_bundle()`); if that version
+    is deleted before it's mapped, the link is resolved again. 
+  ''' 
+  link = _bundle_path(cache_dir, dep_id, day)
+  key = (os.path.abspath(cache_dir), dep_id, day)
+  while True: 
+    path = os.path.realpath(link)
+    try: 
+      (summary, bundle) = _load_bundle(path)
+    except IOError: 
+      if os.path.realpath(link) != path: 
+        continue # Replaced while being read. 
+      (summary, bundle) = (None, None)
+    break
+  if db_con is not None and key not in _validated_bundles:
+    if summary is None or not np.array_equal(summary, _bundle_summary(db_con, dep_id, day)):
+      (path, summary) = _write_bundle(cache_dir, db_con, dep_id, day)
+      (summary, bundle) = _load_bundle(path)
+    _validated_bundles.add(key)
+  elif summary is None: 
+    raise IOError("signal cache: missing bundle '%s'" % link)
+  return bundle
+
+
+### Parallel bearing spectrum computation. ####################################
+
+# Maximum number of pulses per task submitted to a `SpectrumPool`.
+POOL_CHUNK_SIZE = 2000
+
+# Steering vectors of a `SpectrumPool` worker process. They are copied to
+# the worker once when the process starts, so tasks don't carry them.
+_pool_sv = None
+
+def _pool_init(sv):
+  global _pool_sv
+  _pool_sv = sv
+
+def _pool_spectrum(method_name, site):
+  ''' Compute the bearing spectrum of a chunk of pulses in a worker. '''
+  return getattr(Signal, method_name)(site, _pool_sv)
+
+def pool_steering_vectors():
+  ''' Return the steering vectors shared by the calling worker process. '''
+  return _pool_sv
+
+
+class SpectrumPool:
+
+  def __init__(self, sv, processes=None, chunk_size=POOL_CHUNK_SIZE):
+    ''' Process pool for bearing spectrum computation.
+
+      Work is divided into tasks of at most `chunk_size` pulses from one
+      site. The steering vectors are handed to each worker when the pool
+      is created; see `pool_steering_vectors()`.
+
+      Inputs:
+
+        sv -- instance of `class SteeringVectors`.
+
+        processes -- number of worker processes. If `None`, use the number
+                     of CPUs.
+
+        chunk_size -- maximum number of pulses per task.
+    '''
+    self.sv = sv
+    self.chunk_size = chunk_size
+    self.pool = multiprocessing.Pool(processes, _pool_init, (sv,))
+
+  def spectrum_async(self, sig, method=Signal.Bartlet):
+    ''' Submit the bearing spectra of `sig` to the pool.
+
+      `method` is `Signal.MLE` or `Signal.Bartlet`. Returns an object whose
+      `get()` method blocks until the tasks are done and returns the result
+      of `spectrum()`.
+    '''
+    tasks = {}
+    for site_id in sig.get_site_ids().intersection(self.sv.get_site_ids()):
+      site = sig[site_id]
+      tasks[site_id] = [ self.pool.apply_async(_pool_spectrum,
+                           (method.__name__, site.slice(i, i + self.chunk_size)))
+                             for i in range(0, site.count, self.chunk_size) ]
+    return _async_spectrum(tasks)
+
+  def spectrum(self, sig, method=Signal.Bartlet):
+    ''' Return a mapping from siteIDs to the bearing spectra of `sig`. '''
+    return self.spectrum_async(sig, method).get()
+
+  def apply_async(self, func, args=()):
+    ''' Run `func(*args)` in a worker process.
+
+      `func` must be a module-level function. It may call
+      `pool_steering_vectors()` rather than take the steering vectors as
+      an argument.
+    '''
+    return self.pool.apply_async(func, args)
+
+  def close(self):
+    ''' Wait for outstanding tasks and stop the workers. '''
+    self.pool.close()
+    self.pool.join()
+
+
+class _async_spectrum:
+
+  def __init__(self, tasks):
+    self.tasks = tasks # site.ID -> list of pending chunks
+
+  def get(self):
+    bearing_spectrum = {}
+    for (site_id, chunks) in self.tasks.iteritems():
+      if len(chunks) > 0:
+        bearing_spectrum[site_id] = np.vstack([ c.get() for c in chunks ])
+      else:
+        bearing_spectrum[site_id] = np.zeros((0, 360), dtype=np.float64)
+    return bearing_spectrum
+
+
+
 
 ### Simulator. ################################################################
 
@@ -647,7 +1075,15 @@ def Filter(db_con, dep_id, t_start, t_end, param_filter=True):
   for site_id in sites: 
     interval_data[site_id] = []
 
-  for interval in get_score_intervals(t_start, t_end):
+  # Fetch the data for all windows at once, including the overlap of the
+  # first and last windows. 
+  intervals = list(get_score_intervals(t_start, t_end))
+  if len(intervals) > 0:
+    est_data = get_est_data_all(db_con, dep_id, 
+                                (intervals[0][0] - (SCORE_NEIGHBORHOOD / 2), 
+                                 intervals[-1][1] + (SCORE_NEIGHBORHOOD / 2)))
+
+  for interval in intervals:
 
     # Using overlapping windows in order to mitigate 
     # score bias on points at the end of the windows. 
@@ -656,36 +1092,13 @@ def Filter(db_con, dep_id, t_start, t_end, param_filter=True):
 
     data = {}
     for site_id in sites: 
-      data[site_id] = get_est_data(db_con, dep_id, site_id, augmented_interval)
-        
-    no_data = True
-    for site_id in sites:
-      
-      if data[site_id].shape[0] == 0: # Skip empty chunks.
-        debug_output("siteID=%s: skipping empty chunk" % site_id)
-        continue
-      else:
-        no_data = False
-
-      debug_output("siteID=%s: processing %.2f to %.2f (%d pulses)" % (site_id,
-                                                                       interval[0], 
-                                                                       interval[1], 
-                                                                       data[site_id].shape[0]))
-      
-      if param_filter:
-        parametric_filter(data[site_id], tx_params)
-        
-      if data[site_id].shape[0] >= BURST_THRESHOLD: 
-        burst_filter(data[site_id], augmented_interval)
-
-    if not no_data:
-      (pulse_interval, pulse_variation) = expected_pulse_interval(data, tx_params['pulse_rate'])
+      data[site_id] = get_window(est_data.get(site_id), augmented_interval)
+    
+    (pulse_interval, pulse_variation) = filter_window(data, interval, tx_params, param_filter)
 
     for site_id in sites:
 
-      # The only way to coroborate isolated points is with other sites. 
       if data[site_id].shape[0] > 2 and pulse_interval > 0:
-        time_filter(data[site_id], pulse_interval, pulse_variation)
         interval_data[site_id].append((interval[0], float(pulse_interval) / TIMESTAMP_PRECISION, pulse_variation))
       
       # When inserting, exclude overlapping points.
@@ -702,6 +1115,66 @@ def Filter(db_con, dep_id, t_start, t_end, param_filter=True):
   return (total, max_id)
 
 
+def filter_window(data, interval, tx_params, param_filter=True): 
+  ''' Score the pulses of each site over a scoring window. 
+
+    Apply the parametric and burst filters to each site, estimate the pulse 
+    interval over all sites, and then score the pulses with the time filter. 
+    Scores are written to `data` in place. 
+
+    Inputs: 
+
+      data -- mapping from siteIDs to pulse data over the window augmented
+              by `SCORE_NEIGHBORHOOD` (see `get_est_data()`). 
+
+      interval -- scoring window (t_start, t_end). 
+
+      tx_params -- transmitter parameters (see `get_tx_params()`). 
+
+      param_filter -- whether to apply the parametric filter. 
+
+    Returns the expected pulse interval (multiplied by `TIMESTAMP_PRECISION`)
+    and its variation, or (0, 0) if there are no data. Sites with more than 
+    two pulses are scored if the pulse interval is positive. 
+  ''' 
+  
+  augmented_interval = (interval[0] - (SCORE_NEIGHBORHOOD / 2), 
+                        interval[1] + (SCORE_NEIGHBORHOOD / 2))
+
+  no_data = True
+  for (site_id, site_data) in data.iteritems():
+    
+    if site_data.shape[0] == 0: # Skip empty chunks.
+      debug_output("siteID=%s: skipping empty chunk" % site_id)
+      continue
+    else:
+      no_data = False
+
+    debug_output("siteID=%s: processing %.2f to %.2f (%d pulses)" % (site_id,
+                                                                     interval[0], 
+                                                                     interval[1], 
+                                                                     site_data.shape[0]))
+    
+    if param_filter:
+      parametric_filter(site_data, tx_params)
+      
+    if site_data.shape[0] >= BURST_THRESHOLD: 
+      burst_filter(site_data, augmented_interval)
+
+  if no_data:
+    return (0, 0)
+  
+  (pulse_interval, pulse_variation) = expected_pulse_interval(data, tx_params['pulse_rate'])
+
+  # The only way to coroborate isolated points is with other sites. 
+  for site_data in data.itervalues():
+    if site_data.shape[0] > 2 and pulse_interval > 0:
+      time_filter(site_data, pulse_interval, pulse_variation)
+
+  return (pulse_interval, pulse_variation)
+
+
+
 
 
 
@@ -742,22 +1215,70 @@ def get_est_data(db_con, dep_id, site_id, interval):
   return np.array(data, dtype=np.int64)
 
 
+def get_est_data_all(db_con, dep_id, interval):
+  ''' Get pulse data for interval from all sites with a single query. 
+
+    Rows are streamed from the server `util.FETCH_SIZE` at a time. Timestamps 
+    are multiplied by `TIMESTAMP_PRECISION` and truncated by the database, 
+    as in `get_est_data()`. 
+
+    Returns a mapping from siteIDs to pulse data sorted by timestamp. 
+  ''' 
+  
+  cur = db_con.cursor(MySQLdb.cursors.SSCursor)
+  cur.execute('''SELECT ID, siteID, CAST(FLOOR(timestamp * %s) AS SIGNED), 
+                        band3, band10, 0, 0, 0  
+                   FROM est
+                  WHERE deploymentID = %s
+                    AND timestamp >= %s
+                    AND timestamp < %s
+                  ORDER BY siteID, timestamp''', 
+                (TIMESTAMP_PRECISION, dep_id, interval[0], interval[1]))
+  
+  blocks = [np.zeros((0, 8), dtype=np.int64)]
+  rows = cur.fetchmany(util.FETCH_SIZE)
+  while len(rows) > 0:
+    blocks.append(np.array(rows, dtype=np.int64))
+    rows = cur.fetchmany(util.FETCH_SIZE)
+  cur.close()
+  data = np.vstack(blocks)
+
+  # Rows are sorted by site, then by timestamp. 
+  site_ids = np.unique(data[:,1])
+  bounds = np.searchsorted(data[:,1], site_ids, side='right')
+  est_data = {}
+  for (site_id, site_data) in zip(site_ids, np.split(data, bounds[:-1])):
+    est_data[int(site_id)] = site_data
+  return est_data
+
+
+def get_window(data, interval):
+  ''' Return a copy of the pulse data within interval. 
+  
+    `data` is as returned by `get_est_data()` and may be None. The result 
+    is the same as calling `get_est_data()` for the interval. 
+  '''
+  if data is None:
+    return np.zeros((0, 8), dtype=np.int64)
+  (i, j) = np.searchsorted(data[:,2], (interval[0] * TIMESTAMP_PRECISION, 
+                                       interval[1] * TIMESTAMP_PRECISION))
+  return data[i:j].copy()
+
+
 def update_estscore(db_con, data): 
   ''' Insert scored data, updating existng records. 
   
     Return the number of inserted scores and the maximum estID. 
   ''' 
   
-  (row, _) = data.shape; 
-  inserts = []; deletes = []
-  for i in range(row):
-    inserts.append((data[i,0], data[i,5], data[i,6], data[i,7]))
-    deletes.append(data[i,0])
+  inserts = map(tuple, data[:,(0,5,6,7)].tolist())
 
   cur = db_con.cursor()
-  cur.executemany('DELETE FROM estscore WHERE estID = %s', deletes)
-  cur.executemany('''INSERT INTO estscore (estID, score, theoretical_score, max_score) 
-                            VALUES (%s, %s, %s, %s)''', inserts)
+  util.insert_many(cur, '''INSERT INTO estscore (estID, score, theoretical_score, max_score) 
+                                 VALUES''', inserts, 
+                        '''ON DUPLICATE KEY UPDATE score = VALUES(score), 
+                                                theoretical_score = VALUES(theoretical_score), 
+                                                max_score = VALUES(max_score)''')
 
   max_id = np.max(data[:,0]) if len(inserts) > 0 else 0
   return (len(inserts), max_id)
@@ -780,9 +1301,9 @@ def update_intervals(db_con, dep_id, site_id, intervals):
     for (t, pulse_rate, pulse_variation) in intervals:
       inserts.append((dep_id, site_id, t, SCORE_INTERVAL, pulse_rate, pulse_variation))
       
-    cur.executemany('''INSERT INTO estinterval (deploymentID, siteID, timestamp, 
-                                                duration, pulse_interval, pulse_variation)
-                             VALUE (%s, %s, %s, %s, %s, %s)''', inserts)
+    util.insert_many(cur, '''INSERT INTO estinterval (deploymentID, siteID, timestamp, 
+                                                     duration, pulse_interval, pulse_variation)
+                                   VALUES''', inserts)
 
 
 
@@ -833,7 +1354,10 @@ def expected_pulse_interval(data_dict, pulse_rate):
   ''' Compute expected pulse rate over data.
   
     Data is assumed to be sorted by timestamp and timestamps should be
-    multiplied by `TIMESTAMP_PRECISION`. (See `get_est_data()`.)  
+    multiplied by `TIMESTAMP_PRECISION`. (See `get_est_data()`.) The 
+    pairwise time differentials are computed one lag at a time; since the 
+    timestamps are sorted, the differentials only grow with the lag, so 
+    we stop once they all exceed the maximum interval. 
 
     :param pulse_rate: Transmitter's nominal pulse rate in pulses / minute. 
   ''' 
@@ -843,22 +1367,22 @@ def expected_pulse_interval(data_dict, pulse_rate):
   bin_width = int(BIN_WIDTH * TIMESTAMP_PRECISION)
 
   # Compute pairwise time differentials. 
-  diffs = []
+  diffs = [np.zeros(0, dtype=np.int64)]
   for data in data_dict.itervalues():
     if data.shape[0] > 0:
       filtered_data = data[(data[:,5] >= 0),2]#remove already determined "bad" points
-      rows = filtered_data.shape[0]
-      for i in range(rows):
-        for j in range(i+1, rows): 
-          diff = filtered_data[j] - filtered_data[i]
-          if min_interval < diff and diff < max_interval: 
-            diffs.append(diff)
-
-  if len(diffs) <= 2: 
+      for lag in range(1, filtered_data.shape[0]):
+        diff = filtered_data[lag:] - filtered_data[:-lag]
+        if np.min(diff) >= max_interval: 
+          break
+        diffs.append(diff[(min_interval < diff) & (diff < max_interval)])
+  diffs = np.hstack(diffs)
+
+  if diffs.shape[0] <= 2: 
     return (0, 0)
 
   # Create a histogram. Bins are scaled by `BIN_WIDTH`. 
-  (hist, bins) = np.histogram(diffs, bins = 1 + ((max(diffs) - min(diffs)) / bin_width))
+  (hist, bins) = np.histogram(diffs, bins = 1 + ((np.max(diffs) - np.min(diffs)) / bin_width))
   
   # Mode pulse interval = expected pulse interval. 
   i = np.argmax(hist)
@@ -882,10 +1406,8 @@ def parametric_filter(data, tx_params):
     So far we only look at `band3` and `band10`. 
   '''
 
-  (rows, _) = data.shape
-  for i in range(rows): 
-    if data[i,3] > tx_params['band3'] or data[i,4] > tx_params['band10']:
-      data[i,5] = PARAM_BAD
+  bad = (data[:,3] > tx_params['band3']) | (data[:,4] > tx_params['band10'])
+  data[bad,5] = PARAM_BAD
 
 
 def burst_filter(data, interval): 
@@ -905,24 +1427,11 @@ def burst_filter(data, interval):
                                        interval[1] * TIMESTAMP_PRECISION),
                               bins = SCORE_INTERVAL / BURST_INTERVAL)
   
-  # Find bins with bursts. 
-  bad_intervals = []
-  for i in range(len(hist)): 
-    #print "%d pulses from %.2f to %.2f." % (hist[i], 
-    #                float(bins[i]) / TIMESTAMP_PRECISION, 
-    #                float(bins[i+1]) / TIMESTAMP_PRECISION)
-    if (float(hist[i]) / BURST_INTERVAL) > BURST_THRESHOLD: 
-      bad_intervals.append((bins[i], bins[i+1]))
-      # NOTE If it were possible to carry around the row index when
-      # computing the histogram, we could mark signals within bad 
-      # bins here. 
-
-  # Mark signals within bad bins. 
-  (rows, _) = data.shape
-  for i in range(rows): 
-    for (t0, t1) in bad_intervals:
-      if t0 <= data[i,2] and data[i,2] <= t1:
-        data[i,5] = BURST_BAD
+  # Mark signals within bins with bursts, including those on the edges. 
+  bad = np.zeros(data.shape[0], dtype=bool)
+  for i in np.flatnonzero((hist / float(BURST_INTERVAL)) > BURST_THRESHOLD): 
+    bad |= (bins[i] <= data[:,2]) & (data[:,2] <= bins[i+1])
+  data[bad,5] = BURST_BAD
 
 
 def time_filter(data, pulse_interval, pulse_variation, thresh=None):
@@ -930,6 +1439,11 @@ def time_filter(data, pulse_interval, pulse_variation, thresh=None):
     
     `thresh` is either None or in [0 .. 1]. If `thresh` is not none,
     it returns data with relative score of at least this value. 
+
+    Pulses are put into bins of width `pulse_error`. A pulse alone in its
+    bin is scored by the number of bins occupied at multiples of the pulse 
+    interval from it within the neighborhood; the bins are looked up in the
+    sorted array of occupied bins. 
   ''' 
 
   pulse_error = int(SCORE_ERROR(pulse_variation) * TIMESTAMP_PRECISION)
@@ -938,32 +1452,33 @@ def time_filter(data, pulse_interval, pulse_variation, thresh=None):
   # Best score theoretically possible for this interval. 
   theoretical_count = SCORE_NEIGHBORHOOD * TIMESTAMP_PRECISION / pulse_interval
 
-  # Put pulses into at most score_neighborhood / pulse_error bins. 
-  bins = {}
-  for i in range(data.shape[0]):
-    if data[i,5] < 0: # Skip if pulse didn't pass a previous filter. 
-      continue
-  
-    t = data[i,2] - (data[i,2] % pulse_error)
-    if bins.get(t): 
-      bins[t].append(i)
-    else: bins[t] = [i]
-
-  # Score pulses in bins with exactly one pulse. 
-  for points in bins.itervalues():
-    if len(points) > 1: 
-      data[i,5] = 0
-
-    else:
-      count = 0
-      i = points[0]
-      N = (delta / pulse_interval) 
-      for n in range(-N+1, N):
-        t = data[i,2] + (pulse_interval * n)
-        t -= (t % pulse_error)
-        if bins.get(t):
-          count += 1 
-      data[i,5] = count - 1 # Counted myself.
+  # Put pulses into at most score_neighborhood / pulse_error bins. Skip 
+  # pulses that didn't pass a previous filter. 
+  rows = np.flatnonzero(data[:,5] >= 0)
+  t = data[rows,2] - (data[rows,2] % pulse_error)
+  (bins, first, inverse) = np.unique(t, return_index=True, return_inverse=True)
+  size = np.bincount(inverse)
+
+  if bins.shape[0] > 0:
+
+    # Score pulses in bins with exactly one pulse. 
+    N = (delta / pulse_interval) 
+    single = rows[size[inverse] == 1]
+    t = data[single,2][:,np.newaxis] + (pulse_interval * np.arange(-N+1, N))[np.newaxis,:]
+    t -= (t % pulse_error)
+    found = bins[np.searchsorted(bins, t).clip(max=bins.shape[0]-1)] == t
+    
+    # Bins with more than one pulse reset the score of the pulse scored 
+    # before them, in the iteration order of a dictionary keyed by bin, 
+    # or else of the last pulse. The scores were always computed this way,
+    # so the behavior is kept. 
+    order = dict.fromkeys(bins[np.argsort(first)].tolist()).keys()
+    multi = size[np.searchsorted(bins, order)] > 1
+    if multi[0]:
+      data[-1,5] = 0
+    data[single,5] = np.sum(found, 1) - 1 # Counted myself.
+    reset = np.searchsorted(bins, order)[:-1][(~multi[:-1]) & multi[1:]]
+    data[rows[first[reset]],5] = 0
   
   data[:,6] = theoretical_count
-  data[:,7] = np.max(data[:,5]) # Max count. 
+  data[:,7] = np.max(data[:,5]) # Max count.
@@ -38,6 +38,8 @@
 #        likelihood. These would need to be normalized (see notes.)  
 #
 
+from . import util
+
 import numpy as np
 import time, os, sys
 import random
@@ -59,6 +61,14 @@ WINDOW_LENGTH = 500
 #: The overlap (in number of positions) between neighboring positions. 
 OVERLAP_LENGTH = 100
 
+#: Maximum number of candidate transitions tested at once when building the
+#: track graph.
+GRAPH_BLOCK_SIZE = 2 ** 20
+
+#: Number of intervals into which the span of the positions is divided 
+#: when looking for the horizon of the track graph (see `horizon()`). 
+HORIZON_GRID_SIZE = 4096
+
 
 ### High level calls. #########################################################
 
@@ -90,8 +100,8 @@ def get_interval(db_con, dep_id, t_start, t_end):
   return (t_start, t_end)
     
     
-def calc_tracks(db_con, dep_id, t_start, t_end, C=1):
-  ''' Read positions from DB, insert tracks into DB. '''
+def get_maxspeed(db_con, dep_id): 
+  ''' Get the maximum speed function of a deployment's target. '''
   cur = db_con.cursor()
   cur.execute('''SELECT target.ID, max_speed_family, 
                         speed_burst, speed_sustained, speed_limit
@@ -105,16 +115,155 @@ def calc_tracks(db_con, dep_id, t_start, t_end, C=1):
     M = maxspeed_exp((BURST_INTERVAL, burst), (SUSTAINED_INTERVAL, sustained), limit)
   elif family == 'linear':
     M = maxspeed_linear((BURST_INTERVAL, burst), (SUSTAINED_INTERVAL, sustained), limit)
-
+  return M
+    
+def calc_tracks(db_con, dep_id, t_start, t_end, C=1):
+  ''' Read positions from DB, insert tracks into DB. '''
+  M = get_maxspeed(db_con, dep_id)
   pos = Position(db_con, dep_id, t_start, t_end)
   return Track.calc(db_con, pos, dep_id, M, C, optimal=False) 
 
+def update_tracks(db_con, dep_id, t_resume, C=1): 
+  ''' Extend the track of a deployment with the positions from `t_resume` on. 
+
+    The length and parent of the longest path to each tracked position is 
+    kept in the `track_node` table. The critical path algorithm resumes
+    from the nodes within the `horizon()` before `t_resume`, plus the best 
+    node before those, which stands for the rest. The horizon is bounded
+    using the extent and time span of all positions of the deployment, so 
+    every node before it has an edge to every new position. Nodes from 
+    `t_resume` on are (re)computed, so positions may arrive out of order. 
+
+      Only the part of the track after the point where the new critical 
+    path joins the old one is replaced in `track_pos`. Return it as a 
+    track. 
+  ''' 
+  M = get_maxspeed(db_con, dep_id)
+  cur = db_con.cursor()
+  track = Track()
+  track.dep_id = dep_id
+
+  cur.execute('''SELECT ID, deploymentID, timestamp, easting, northing, 
+                        utm_zone_number, utm_zone_letter, likelihood, activity
+                   FROM position
+                  WHERE deploymentID = %s
+                    AND timestamp >= %s
+                  ORDER BY timestamp ASC, ID ASC''', (dep_id, t_resume))
+  new_pos = list(cur.fetchall())
+  if len(new_pos) == 0: 
+    return track
+
+  # Horizon of the track graph over all positions of the deployment. 
+  cur.execute('''SELECT MIN(timestamp), MIN(easting), MAX(easting), 
+                        MIN(northing), MAX(northing)
+                   FROM position
+                  WHERE deploymentID = %s''', (dep_id,))
+  (t_first, e_min, e_max, n_min, n_max) = map(float, cur.fetchone())
+  h = horizon(np.array([t_first, float(new_pos[-1][2])]), 
+              np.array([np.complex(n_min, e_min), np.complex(n_max, e_max)]), M)
+  t_cut = t_resume - h if h < np.inf else t_first
+  
+  # pos row, followed by dist and parentID of the node. 
+  query = '''SELECT position.ID, position.deploymentID, position.timestamp, 
+                    easting, northing, utm_zone_number, utm_zone_letter, 
+                    likelihood, activity, dist, parentID
+               FROM track_node
+               JOIN position ON position.ID = track_node.positionID
+              WHERE track_node.deploymentID = %s'''
+  cur.execute(query + ''' AND track_node.timestamp < %s
+                        ORDER BY dist DESC, track_node.timestamp ASC, positionID ASC
+                        LIMIT 1''', (dep_id, t_cut))
+  frontier = list(cur.fetchall())
+  cur.execute(query + ''' AND track_node.timestamp >= %s
+                          AND track_node.timestamp < %s
+                        ORDER BY track_node.timestamp ASC, positionID ASC''', (dep_id, t_cut, t_resume))
+  frontier += list(cur.fetchall())
+  pos = map(lambda(row) : row[:9], frontier) + new_pos
+  k = len(frontier) 
+
+  # Extend longest paths. 
+  graph = track.graph(pos, M)
+  n = len(graph)
+  index = dict((int(row[0]), j) for (j, row) in enumerate(pos))
+  dist = np.zeros(n, dtype=float)
+  parent = -np.ones(n, dtype=int)
+  for (j, row) in enumerate(frontier):
+    dist[j] = row[9]
+    if row[10] is not None: 
+      parent[j] = index.get(int(row[10]), -1)
+  (dist, parent, best) = track.longest_paths(graph, C, dist, parent, k)
+
+  cur.execute('''DELETE FROM track_node
+                  WHERE deploymentID = %s
+                    AND timestamp >= %s''', (dep_id, t_resume))
+  inserts = []
+  for j in range(k, n):
+    inserts.append((int(pos[j][0]), int(dep_id), pos[j][2], float(dist[j]),
+                    int(pos[parent[j]][0]) if parent[j] > -1 else None))
+  util.insert_many(cur, '''INSERT INTO track_node (positionID, deploymentID, 
+                                                   timestamp, dist, parentID)
+                                VALUES''', inserts)
+
+  # Trace the critical path back to where it joins the current track. Nodes
+  # before `t_resume` haven't changed, and neither has the track before them. 
+  cur.execute('''SELECT positionID 
+                   FROM track_pos
+                  WHERE deploymentID = %s
+                    AND timestamp >= %s''', (dep_id, pos[0][2]))
+  on_track = set(map(lambda(row) : int(row[0]), cur.fetchall()))
+  suffix = []; join = None
+  j = best[-1] if dist[best[-1]] > 0 else -1
+  while j != -1: 
+    if j < k and int(pos[j][0]) in on_track:
+      join = pos[j]
+      break
+    suffix.append(pos[j])
+    if j < k and parent[j] == -1 and frontier[j][10] is not None: 
+      # The parent is before the frontier. 
+      parent_id = frontier[j][10]
+      while parent_id is not None: 
+        cur.execute('''SELECT position.ID, position.deploymentID, position.timestamp, 
+                              easting, northing, utm_zone_number, utm_zone_letter, 
+                              likelihood, activity, dist, parentID, track_pos.ID
+                         FROM track_node
+                         JOIN position ON position.ID = track_node.positionID
+                         LEFT JOIN track_pos ON track_pos.positionID = track_node.positionID
+                        WHERE track_node.positionID = %s''', (parent_id,))
+        row = cur.fetchone()
+        if row is None: 
+          break
+        elif row[11] is not None: 
+          join = row[:9]
+          break
+        suffix.append(row[:9])
+        parent_id = row[10]
+      break
+    j = parent[j]
+  suffix.reverse()
+
+  # Replace the track after the join. 
+  if join is not None: 
+    cur.execute('''DELETE FROM track_pos
+                    WHERE deploymentID = %s
+                      AND timestamp > %s''', (dep_id, join[2]))
+  elif len(suffix) > 0: 
+    cur.execute('''DELETE FROM track_pos
+                    WHERE deploymentID = %s
+                      AND timestamp >= %s''', (dep_id, suffix[0][2]))
+  util.insert_many(cur, '''INSERT INTO track_pos (positionID, deploymentID, timestamp)
+                                VALUES''', map(lambda(row) : (int(row[0]), int(dep_id), row[2]), suffix))
+
+  for row in suffix: 
+    track.table.append((int(row[0]), int(dep_id), float(row[2]), float(row[3]), float(row[4]), 
+                        row[5], row[6], float(row[7]), row[8]))
+  return track
+
 
 
 ### Target maximum speed (m/s) funciton familes. ##############################
 
 def maxspeed_linear(burst, sustained, limit):
-  return lambda (t) : max(limit, (t - burst[0]) * (
+  return lambda (t) : np.maximum(limit, (t - burst[0]) * (
           float(sustained[1] - burst[1]) / (sustained[0] - burst[0])) + burst[1])
 
 def maxspeed_exp(burst, sustained, limit):
@@ -147,6 +296,37 @@ def acceleration(u, v, w):
   t2 = (w.t + v.t) / 2  
   return np.abs((V2 - V1) / (t2 - t1))
 
+def horizon(t, P, M):
+  ''' Time interval beyond which any transition between positions is feasible.
+
+    This is the shortest interval after which the target could cross the
+    bounding box of the positions in any longer interval that occurs
+    between them. `dt * M(dt)` needn't increase with `dt`, e.g. for the
+    linear and exponential families, so it's bounded on a grid of 
+    `HORIZON_GRID_SIZE` intervals over the span of the timestamps. This 
+    assumes `M` is monotone; the result may exceed the exact horizon by
+    a grid step. Return infinity if there is no such interval.
+
+    :param t: Sorted timestamps of positions.
+    :type t: np.ndarray
+    :param P: Positions (northing + easting * i).
+    :type P: np.ndarray
+    :param M: Maximum target speed as a function of the time interval.
+    :rtype: float
+  '''
+  if len(t) == 0:
+    return np.inf
+  extent = np.abs(np.complex(P.real.max() - P.real.min(),
+                             P.imag.max() - P.imag.min()))
+  dt = np.linspace(0, t[-1] - t[0], HORIZON_GRID_SIZE + 1)
+  m = M(dt) * np.ones(dt.shape)
+  # Lower bound of dt * M(dt) over each grid interval. 
+  feasible = (dt[:-1] * np.minimum(m[:-1], m[1:])) > extent
+  if not feasible[-1]:
+    return np.inf
+  i = np.flatnonzero(~feasible)[-1]
+  return dt[i+1]
+
 
 
 ### Track object. #############################################################
@@ -210,10 +390,12 @@ class Track:
                            WHERE timestamp >= %s 
                              AND timestamp <= %s
                              AND deploymentID = %s''', (self.table[0][2], self.table[-1][2], self.dep_id)) 
+      inserts = []
       for (pos_id, dep_id, t, easting, northing, utm_zone_number, 
            utm_zone_letter, likelihood, activity) in self.table:
-        cur.execute('''INSERT INTO track_pos (positionID, deploymentID, timestamp)
-                            VALUES (%d, %d, %d)''' % (pos_id, self.dep_id, t))
+        inserts.append((int(pos_id), int(self.dep_id), int(t)))
+      util.insert_many(cur, '''INSERT INTO track_pos (positionID, deploymentID, timestamp)
+                                    VALUES''', inserts)
 
   def _calc_tracks_windowed(self, M, C):
     ''' Calculate tracks over overlapping windows of positions. 
@@ -258,8 +440,8 @@ class Track:
         j -= 1
       
       # Compute critical path over point DAG. 
-      roots = self.graph(self.pos[i:j+1], M)
-      windowed_track = self.critical_path(self.toposort(roots), C)
+      graph = self.graph(self.pos[i:j+1], M)
+      windowed_track = self.critical_path(graph, C)
       
       for node in windowed_track: 
         if not pos_dict.get(node.t):
@@ -272,7 +454,7 @@ class Track:
     # in this process.)
     self.track = []
     for (t, val) in sorted(pos_dict.items(), key=lambda(m) : m[0]):
-      node = max(val, key=lambda(row) : node.t)
+      node = max(val, key=lambda(node) : node.ll)
       self.track.append(node)
     
 
@@ -280,12 +462,13 @@ class Track:
   def _calc_tracks(self, M, C):
     ''' Calculate optimal tracks over all positions. 
     
-      This track algorithm considers all possible transitions, 
-      resulting in a quadratic factor in the running time. However,
-      the solution is optimal for the time window.
+      This track algorithm considers all possible transitions. Those 
+      beyond the horizon of the graph are implicit, so the running time
+      is quadratic in the number of positions within the horizon. The 
+      solution is optimal for the time window.
     ''' 
-    roots = self.graph(self.pos, M)
-    self.track = self.critical_path(self.toposort(roots), C)
+    graph = self.graph(self.pos, M)
+    self.track = self.critical_path(graph, C)
   
   def __getiter__(self): 
     return self.table
@@ -305,16 +488,22 @@ class Track:
           
       Each position corresponds to a node. An edge is drawn between nodes with 
       a feasible transition, i.e. distance(Pi, Pj) / (Tj - Ti) < M. The result
-      will be a directed, acyclic graph. We define the roots of this graph to 
-      be a set of nodes from which all nodes are reachable.
+      will be a directed, acyclic graph. 
+
+        The positions are swept in time order. Once the interval between two
+      positions exceeds the `horizon()`, the transition is feasible whatever
+      the distance; these edges are implicit. Transitions within the horizon
+      are tested in blocks of up to `GRAPH_BLOCK_SIZE` and stored as CSR
+      index arrays. 
 
       :param pos: A list of 4-tuples (northing, easting, t, ll) sorted by t 
                   corresponding to positions. 
       :type pos: (np.complex, float, float) list 
-      :param M: Maximum target speed. 
-      :type M: float
-      :return: The roots of the graph. 
-      :rtype: Node list
+      :param M: Maximum target speed as a function of the time interval. It
+                is applied to arrays of intervals. 
+      :type M: function
+      :return: The track graph. 
+      :rtype: Graph
     '''
     
     # pos row: (id, tx_id, timestamp, easting, northing, 
@@ -327,85 +516,121 @@ class Track:
                         int(pos[i][0]),                   # pos_id
                         pos[i][5], pos[i][6],             # UTM
                         float(pos[i][8])))                # actiivty
-      
-    for i in range(len(nodes)):
-      for j in range(i+1, len(nodes)):
-        if nodes[i].t < nodes[j].t and speed(nodes[i], nodes[j]) < M(nodes[j].t - nodes[i].t): 
-          nodes[i].adj_out.append(nodes[j])
-          nodes[j].adj_in.append(nodes[i]) 
-  
-    roots = [] 
-    for u in nodes:
-      if len(u.adj_in) == 0:
-        roots.append(u) 
+    
+    n = len(nodes)
+    t = np.array([u.t for u in nodes], dtype=float)
+    P = np.array([u.P for u in nodes], dtype=np.complex)
+    
+    # Candidate predecessors of node j are lo[j], ..., hi[j]-1. Nodes 
+    # before lo[j] are beyond the horizon; those from hi[j] on aren't
+    # earlier than node j. 
+    lo = np.searchsorted(t, t - horizon(t, P, M), 'right')
+    hi = np.searchsorted(t, t, 'left')
+    
+    # Blocks of consecutive nodes with at most `GRAPH_BLOCK_SIZE` candidate
+    # pairs in all (or a single node with more). 
+    count = np.maximum(hi - lo, 0)
+    total = np.concatenate(([0], np.cumsum(count)))
+    indptr = np.zeros(n+1, dtype=int)
+    indices = []
+    j0 = 0
+    while j0 < n: 
+      j1 = max(j0 + 1, np.searchsorted(total, total[j0] + GRAPH_BLOCK_SIZE, 'right') - 1)
+      ct = count[j0:j1]
+      if total[j1] > total[j0]:
+        # Pairs (ii, jj) of the band: row j repeated for ii = lo[j], ..., hi[j]-1.
+        jj = np.repeat(np.arange(j0, j1), ct)
+        ii = (np.arange(len(jj)) - np.repeat(total[j0:j1] - total[j0], ct) + 
+              np.repeat(lo[j0:j1], ct))
+        dt = t[jj] - t[ii] 
+        feasible = np.abs((P[jj] - P[ii]) / dt) < M(dt)
+        indices.append(ii[feasible].astype(np.int32))
+        indptr[j0+1:j1+1] = np.bincount(jj[feasible] - j0, minlength=j1-j0)
+      j0 = j1
+    
+    indptr = np.cumsum(indptr)
+    if len(indices) > 0: 
+      indices = np.hstack(indices)
+    else: 
+      indices = np.zeros(0, dtype=np.int32)
    
-    return roots
+    return Graph(nodes, lo, indptr, indices)
   
   #
   # Methods for calculating the critical path over the graph.
   #
 
-  def toposort(self, roots): 
-    ''' Compute a topological sorting of the track graph. Return None if 
-        no sorting exists, i.e. graph has a cycle. 
-    
-      :param roots: Roots of the graph.
-      :type roots: Node list
-      :return: The sorted nodes.
-      :rtype: Node list or None
-    ''' 
-    sorted_nodes = [] 
-
-    for r in roots:
-      S = [r]
-      while (len(S) != 0):
-        u = S[-1]
-        u.t_visited = True
-        ok = False
-        for v in u.adj_out:
-          if v.t_visited and not v.t_sorted:
-            return None # Graph contains cycle. 
-          elif not v.t_visited:
-            S.append(v)
-            ok = True
-        if not ok: # No children to visit.  
-          u.t_sorted = True
-          sorted_nodes.append(u) 
-          S.pop()
-
-    sorted_nodes.reverse()
-    return sorted_nodes
-
-  def critical_path(self, sorted_nodes, C): 
-    ''' Calculate the critical path of the track graph.
+  def longest_paths(self, graph, C, dist=None, parent=None, start=0): 
+    ''' Calculate the longest path to each node of the track graph.
+
+      The nodes are sorted by time, which is a topological order of the 
+      graph. The longest path to each node is computed in this order, 
+      keeping the distances and parents in arrays. The best of a node's
+      implicit predecessors is looked up in a running maximum over the 
+      distances. 
 
-      :param sorted_nodes: Topologically sorted graph nodes. 
-      :type sorted_nodes: NOde list
+      :param graph: The track graph.
+      :type graph: Graph
       :param C: Constant hop cost. 
       :type C: float
+      :param dist: Path lengths, given for nodes `0, ..., start-1`. 
+      :type dist: np.ndarray
+      :param parent: Index of the parent of each node (-1 for none), given 
+                     for nodes `0, ..., start-1`. 
+      :type parent: np.ndarray
+      :param start: Index of the first node to compute. 
+      :type start: int
+      :return: `(dist, parent, best)`, where `best[j]` is the first node of
+               maximum distance in `0, ..., j`. 
+      :rtype: (np.ndarray, np.ndarray, np.ndarray)
     '''
 
-    cost = 0
-    node = None
-    for v in sorted_nodes: 
-      mdist = 0
-      mparent = None
-      for u in v.adj_in:
-        if u.dist > mdist:
-          mdist = u.dist
-          mparent = u
-      v.parent = mparent
-      v.dist = mdist + C + v.ll 
-     
-      if v.dist > cost:
-        cost = v.dist
-        node = v
+    n = len(graph)
+    ll = np.array([v.ll for v in graph.nodes], dtype=float)
+    if dist is None: 
+      dist = np.zeros(n, dtype=float)
+    if parent is None: 
+      parent = -np.ones(n, dtype=int)
+    best = np.zeros(n, dtype=int) 
+    for j in range(n): 
+      if j >= start: 
+        (mdist, mparent) = (0, -1)
+        k = graph.far[j]
+        if k > 0 and dist[best[k-1]] > mdist:
+          (mdist, mparent) = (dist[best[k-1]], best[k-1])
+        pred = graph.indices[graph.indptr[j]:graph.indptr[j+1]]
+        if len(pred) > 0: 
+          i = pred[np.argmax(dist[pred])]
+          if dist[i] > mdist: 
+            (mdist, mparent) = (dist[i], i)
+        parent[j] = mparent
+        dist[j] = mdist + C + ll[j]
+      if j > 0 and dist[j] <= dist[best[j-1]]: 
+        best[j] = best[j-1]
+      else: 
+        best[j] = j
+
+    return (dist, parent, best)
+
+  def critical_path(self, graph, C): 
+    ''' Calculate the critical path of the track graph.
 
+      :param graph: The track graph.
+      :type graph: Graph
+      :param C: Constant hop cost. 
+      :type C: float
+      :return: The nodes of the path. 
+      :rtype: Node list
+    '''
+
+    (dist, parent, best) = self.longest_paths(graph, C)
     path = []
     
-    while node != None:
-      path.append(node)
-      node = node.parent
+    if len(graph) > 0 and dist[best[-1]] > 0:
+      j = best[-1]
+      while j != -1:
+        path.append(graph.nodes[j])
+        j = parent[j]
     
     path.reverse()
     return path
@@ -510,73 +735,54 @@ class Track:
     #      A.append((a, (V[i].t + V[i+1].t) / 2))
     #
     #    return (map(lambda(v, t) : np.abs(v), V), map(lambda(a, t) : np.abs(a), A))
-    
-    
-  def graph_alt(self, pos): 
-    ''' Alternative DAG-building algorithm. 
-    
-      This is an attempt to reduce the complexity of the graph. The number 
-      of possible edges is O(n choose 2). We test a new node for a feasible
-      transition from a set of graph leaves. The problem is that segments of
-      the true track of the target can be orphaned by the process. More
-      thinking is required. **TODO** 
-    '''
-    
-    # TODO update this code to include positionID in Node() constructor.
-    # TODO row format has changed!!
-    roots = []; leaves = []
-    i = 0 
-    while i < len(pos) - 1:
-      
-      j = i
-      Ti = Tj = float(pos[i][2])
-      newLeaves = []
-      while j < len(pos) - 1 and Ti == Tj: # Candidates for next time interval. 
-        (P, ll, pos_id) = (np.complex(pos[j][0], pos[j][1]), float(pos[j][3]), pos[j][4])
-
-        w = Node(P, Tj, ll, pos_id)
-        ok = False
-        for v in leaves:
-          if speed(v, w) < M(w.t - v.t):
-            ok = True
-            w.adj_in.append(v)
-            v.adj_out.append(w)
-            w.c_union(v)
-        
-        if not ok: # New root. 
-          roots.append(w) 
-          newLeaves.append(w)
-
-        j += 1
-        Tj = float(pos[j][2])
-
-      # Recalculate leaves. 
-      for u in leaves:
-        if len(u.adj_out) == 0: 
-          newLeaves.append(u)
-        else: 
-          for v in u.adj_out:
-            if v not in newLeaves: # FIXME O(n)
-              newLeaves.append(v)
-      leaves = newLeaves
-
-      i = j 
-
-    # Exclude isolated nodes.
-    #retRoots = []
-    #for node in roots:
-    #  if node.c_find().c_size > 1:
-    #    retRoots.append(node)
-    #return retRoots
-    
-    return roots
+
+
+
+
+### Graph object. #############################################################
+
+class Graph:
+
+  ''' Track graph.
+
+    Nodes are sorted by time. The predecessors of node `j` are nodes
+    `0, ..., far[j]-1`, which are beyond the horizon, and nodes
+    `indices[indptr[j]:indptr[j+1]]`, in increasing order.
+
+    :param nodes: Graph nodes.
+    :type nodes: Node list
+    :param far: Number of implicit predecessors of each node.
+    :type far: np.ndarray
+    :param indptr: Index pointers of the explicit predecessor lists.
+    :type indptr: np.ndarray
+    :param indices: Explicit predecessors.
+    :type indices: np.ndarray
+  '''
+
+  def __init__(self, nodes, far, indptr, indices):
+    self.nodes = nodes
+    self.far = far
+    self.indptr = indptr
+    self.indices = indices
+
+  def __len__(self):
+    return len(self.nodes)
+
+  def predecessors(self, j):
+    ''' Indices of the nodes with an edge to node `j`. '''
+    return np.hstack((np.arange(self.far[j]),
+                      self.indices[self.indptr[j]:self.indptr[j+1]]))
+
+  def roots(self):
+    ''' Indices of the nodes without predecessors. '''
+    return np.flatnonzero((self.far == 0) & (np.diff(self.indptr) == 0))
 
 
 
 
 ### Node object. ##############################################################
 
-class Node:
+class Node (object):
 
   ''' Node of track graph. 
   
@@ -588,6 +794,8 @@ class Node:
     :type ll: float
   '''
 
+  __slots__ = ('P', 't', 'll', 'pos_id', 'utm_number', 'utm_letter', 'activity')
+
   def __init__(self, P, t, ll, pos_id, utm_number, utm_letter, activity): 
     # Position.  
     self.P = P
@@ -598,67 +806,10 @@ class Node:
     self.utm_letter = utm_letter
     self.activity = activity
 
-    # Connected component analysis. 
-    self.c_size   = 1
-    self.c_height = 0
-    self.c_parent = None
-  
-    # Topological sorting. 
-    self.t_visited = False
-    self.t_sorted = False
-
-    # Generic. 
-    self.dist = 0
-    self.parent = None
-    self.adj_in = []
-    self.adj_out = []
-
-  def reset(self):
-    ''' Reset algorithm paramaters. ''' 
-    self.c_size   = 1
-    self.c_height = 0
-    self.c_parent = None
-    self.dist     = 0 
-    self.parent   = None
-
   def distance(self, u):
     ''' Compute Euclidean distance to another node. ''' 
     return distance(self.P, u.P)
 
-  def c_find(self):
-    ''' Disjoint-set find operation for CC-analysis. ''' 
-    p = self
-    while (p.c_parent != None): 
-      p = p.c_parent
-    return p
-
-  def c_union(self, u):
-    ''' Disjoint-set union operation for CC-analysis. ''' 
-
-    x = self.c_find()
-    y = u.c_find()
-
-    if (x == y): # This and u are in the same component. 
-      p = x
-    
-    elif (x.c_height == y.c_height): # x and y have the same height.
-      y.c_parent  = x
-      x.c_height += 1
-      x.c_size   += y.c_size
-      p = x
-
-    elif (x.c_height > y.c_height): # x is taller than y.
-      y.c_parent = x
-      x.c_size  += y.c_size
-      p = x
-
-    else: # y is taller than x.
-      x.c_parent = y
-      y.c_size  += x.c_size
-      p = y
-    
-    return p
-
 
 
 
@@ -20,7 +20,7 @@ import MySQLdb as mdb
 
 import os, sys
 import qraat
-import time, datetime
+import time, datetime, itertools
 import numpy as np
 
 def remove_field(l, i):
@@ -74,6 +74,85 @@ def compute_time_windows(t_start, t_end, t_step, t_window):
 
 ### Common database accessors. ################################################
 
+# Number of rows fetched at a time from a server-side cursor. 
+FETCH_SIZE = 10000
+
+def fetch_array(cur, ct, width, dtype=float):
+  ''' Fetch the result of a query into an array. 
+
+    Rows are fetched `FETCH_SIZE` at a time into an array of `ct` rows 
+    allocated up front, so the result set is never held as a list of 
+    tuples. This is intended for a server-side cursor (`SSCursor`) and 
+    an expected row count from a preceding COUNT(*). If fewer rows 
+    arrive, the array is truncated; if more arrive (e.g. rows inserted 
+    in the meantime), they are appended. 
+
+    Inputs: 
+
+      cur -- cursor on which a query has been executed. 
+
+      ct -- expected number of rows. 
+
+      width -- number of columns. 
+  ''' 
+  data = np.empty((ct, width), dtype=dtype)
+  extra = []; i = 0
+  rows = cur.fetchmany(FETCH_SIZE)
+  while len(rows) > 0:
+    j = min(ct, i + len(rows))
+    if j > i:
+      data[i:j] = rows[:j-i]
+    if j - i < len(rows): 
+      extra.append(np.array(rows[j-i:], dtype=dtype))
+    i += len(rows)
+    rows = cur.fetchmany(FETCH_SIZE)
+  cur.close()
+  if i < ct: 
+    return data[:i]
+  elif len(extra) > 0:
+    return np.vstack([data] + extra)
+  return data
+
+# Maximum number of rows inserted by one statement in `insert_many()`. 
+INSERT_BATCH_SIZE = 1000
+
+def insert_many(cur, query, rows, suffix='', batch_size=None):
+  ''' Insert rows with multi-row INSERT statements. 
+
+    MySQLdb sends one statement per row for `executemany()` unless it 
+    recognizes the query, which it doesn't for every form of INSERT. 
+
+    Inputs: 
+
+      cur -- database cursor. 
+
+      query -- INSERT statement up to and including VALUES, e.g. 
+               'INSERT INTO t (a, b) VALUES'. 
+
+      rows -- list of tuples of values. 
+
+      suffix -- appended to each statement, e.g. an ON DUPLICATE KEY 
+                UPDATE clause. 
+
+      batch_size -- maximum number of rows per statement. (Default is
+                    `INSERT_BATCH_SIZE`.)
+
+    Returns the AUTO_INCREMENT IDs of the inserted rows. The IDs assigned by 
+    a multi-row INSERT into a MyISAM table are consecutive, starting with 
+    `cur.lastrowid`. (Not meaningful for tables without such a key, or if 
+    rows are updated rather than inserted.) 
+  '''
+  if batch_size is None: 
+    batch_size = INSERT_BATCH_SIZE
+  ids = []
+  for i in range(0, len(rows), batch_size):
+    batch = rows[i:i+batch_size]
+    values = '(%s)' % ', '.join(['%s'] * len(batch[0]))
+    cur.execute('%s %s %s' % (query, ', '.join([values] * len(batch)), suffix), 
+                tuple(itertools.chain(*batch)))
+    ids += range(cur.lastrowid, cur.lastrowid + len(batch))
+  return ids
+
 def get_center(db_con):
   ''' Get the center defined in the database. '''
   cur = db_con.cursor()